@@ -1,11 +1,12 @@
 import itertools
 
-import numpy as np
-
 import battle_engine
+import events
 
 
 class Heal(battle_engine.Ability):
+  __slots__ = ('amount',)
+
   def __init__(self, amount, ap_cost=1, mana_cost=1):
     battle_engine.Ability.__init__(self, 'Heal %d' % amount, ap_cost, mana_cost)
     self.amount = amount
@@ -15,6 +16,8 @@ class Heal(battle_engine.Ability):
 
 
 class AreaFlames(battle_engine.Ability):
+  __slots__ = ('amount',)
+
   def __init__(self, amount, ap_cost=1, mana_cost=1):
     battle_engine.Ability.__init__(
         self, 'Area Flames %d' % amount, ap_cost, mana_cost)
@@ -22,40 +25,46 @@ class AreaFlames(battle_engine.Ability):
 
   def use(self, user, battle):
     for enemy in battle.enemies:
-      flames_damage = battle_engine.compute_damage(
-          power=0,
-          strength=0,
-          resistance=1,
-          damage_bonus=self.amount,
-          armor=enemy.get_armor(battle_engine.SPECIAL),
-          damage_mult=1,
-          received_damage_mult=enemy.get_received_damage_multiplier(
-              battle_engine.SPECIAL))
+      flames_damage = enemy.get_fixed_damage(self.amount,
+                                             battle_engine.SPECIAL)
       enemy.take_damage(flames_damage)
 
 
 class ApplyAura(battle_engine.Ability):
+  __slots__ = ('aura_constructor',)
+
   def __init__(self, name, aura_constructor, ap_cost=1, mana_cost=1):
     battle_engine.Ability.__init__(self, name, ap_cost, mana_cost)
     self.aura_constructor = aura_constructor
 
   def use(self, user, battle):
-    target = battle_engine.choose_option(battle.players + battle.enemies)
+    target = battle.context.choose(battle.players + battle.enemies)
     aura = self.aura_constructor()
-    target.auras.append(aura)
+    target.add_aura(aura)
+    sink = battle.context.sink
+    if sink.enabled:
+      sink.emit(events.AuraApplied(target, aura))
 
 
 class AffectStat(ApplyAura):
+  __slots__ = ('target_stat', 'amount', 'duration')
+
   def __init__(self, name, target_stat, amount, duration, ap_cost=1,
                mana_cost=1):
     name = '%s %s %s' % (name, *target_stat)
-    aura_constructor = lambda: battle_engine.Aura(name,
-                                                  {target_stat: amount},
-                                                  duration)
-    ApplyAura.__init__(self, name, aura_constructor, ap_cost, mana_cost)
+    self.target_stat = target_stat
+    self.amount = amount
+    self.duration = duration
+    ApplyAura.__init__(self, name, self.create_aura, ap_cost, mana_cost)
+
+  def create_aura(self):
+    return battle_engine.Aura(self.name, {self.target_stat: self.amount},
+                              self.duration)
 
 
 class Pray(battle_engine.Ability):
+  __slots__ = ('abilities', 'num_choices')
+
   def __init__(self, buff_add_amount=0.5, buff_mult_amount=1.25,
                seal_add_amount=0.5, seal_mult_amount=0.75, duration=3,
                specials=None, num_choices=5, ap_cost=1, mana_cost=1):
@@ -83,7 +92,8 @@ class Pray(battle_engine.Ability):
     return additive + multiplicative
 
   def use(self, user, battle):
-    options = np.random.choice(self.abilities, self.num_choices, replace=False)
-    ability = battle_engine.choose_option(options)
+    options = battle.context.np_rng.choice(self.abilities, self.num_choices,
+                                           replace=False)
+    ability = battle.context.choose(options)
     ability.use(user, battle)
 
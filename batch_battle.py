@@ -0,0 +1,480 @@
+"""Lockstep engine that advances many copies of one battle with NumPy.
+
+Covers the common balance-testing case: one player who attacks, drinks
+Potions and casts Heal and AreaFlames, against enemies that use the standard
+`Enemy.take_turn` attack (HornDog thorns included). All M battles start from
+the same actors; HP, mana, aura durations and aura aggregates are held in
+arrays and every call to `step` performs one action in every unfinished
+battle. `check_equivalence` compares its outcome statistics against the
+object engine in `battle_engine`.
+"""
+import argparse
+import math
+
+import numpy as np
+
+import battle_engine
+import create_character
+import simulate
+
+import abilities
+import enemies
+import items
+
+
+PLAYER = 0
+
+# Player action codes.
+END_TURN = 0
+ATTACK = 1
+POTION = 2
+HEAL = 3
+FLAMES = 4
+
+POTION_AMOUNT = 5
+
+
+def compute_damage(power, strength, resistance, damage_bonus, armor,
+                   damage_mult, received_damage_mult):
+  """`battle_engine.compute_damage` over arrays."""
+  raw_damage = power * strength / resistance + damage_bonus - armor
+  return np.maximum(0, raw_damage) * damage_mult * received_damage_mult
+
+
+class ThresholdPolicy(simulate.Policy):
+  """Fixed-rule player policy that both engines can execute.
+
+  In order of preference: drink a Potion at or below `potion_below` hp, cast
+  the biggest affordable Heal at or below `heal_below` hp, cast the biggest
+  affordable AreaFlames against at least `flames_min_enemies` enemies, attack
+  the first enemy, end the turn.
+  """
+  def __init__(self, potion_below=4, heal_below=6, flames_min_enemies=2):
+    self.potion_below = potion_below
+    self.heal_below = heal_below
+    self.flames_min_enemies = flames_min_enemies
+    self.plan = []
+
+  def reset(self):
+    self.plan = []
+
+  def choose(self, options):
+    if battle_engine.END_TURN in options:
+      action, self.plan = self.plan_action()
+      return action
+    return self.plan.pop(0)
+
+  def plan_action(self):
+    """Return the next action and the answers to its follow-up prompts."""
+    actor, battle = self.actor, self.battle
+    action_points = actor.action_points
+    if (actor.hp <= self.potion_below and
+        action_points >= battle_engine.ACTION_COST[battle_engine.ITEM]):
+      for item in actor.inventory:
+        if type(item) is items.Potion:
+          return battle_engine.ITEM, [item, actor]
+    heal = self.biggest(abilities.Heal)
+    if actor.hp <= self.heal_below and heal is not None:
+      return battle_engine.ABILITY, [heal]
+    flames = self.biggest(abilities.AreaFlames)
+    if len(battle.enemies) >= self.flames_min_enemies and flames is not None:
+      return battle_engine.ABILITY, [flames]
+    if action_points >= battle_engine.ACTION_COST[battle_engine.ATTACK]:
+      return battle_engine.ATTACK, [battle.enemies[0]]
+    return battle_engine.END_TURN, []
+
+  def biggest(self, ability_type):
+    available = [
+        ability for ability in self.actor.get_available_abilities(
+            self.actor.action_points, self.actor.mana)
+        if type(ability) is ability_type]
+    if not available:
+      return None
+    return max(available, key=lambda ability: ability.amount)
+
+
+class BatchBattle():
+  """M independent copies of a battle between `player` and `battle_enemies`.
+
+  The actors are only read, never modified.
+  """
+  def __init__(self, player, battle_enemies, num_battles, policy, seed=None,
+               max_rounds=simulate.DEFAULT_MAX_ROUNDS):
+    check_supported(player, battle_enemies)
+    self.num_battles = num_battles
+    self.policy = policy
+    self.max_rounds = max_rounds
+    self.rng = np.random.default_rng(seed)
+
+    actors = [player] + list(battle_enemies)
+    self.num_actors = len(actors)
+    self.stats = np.array([actor.stats.values for actor in actors])
+    self.base_damage = np.array([
+        [actor.get_base_damage(damage_type)
+         for damage_type in battle_engine.DAMAGE_TYPES]
+        for actor in actors], dtype=float)
+    tags = [player.get_attack_tags()] + [
+        enemy.get_standard_attack_tags() for enemy in battle_enemies]
+    self.tags = np.array([
+        [damage_type in actor_tags
+         for damage_type in battle_engine.DAMAGE_TYPES]
+        for actor_tags in tags])
+    self.thorns = np.array([0] + [getattr(enemy, 'thorns_damage', 0)
+                                  for enemy in battle_enemies], dtype=float)
+    self.has_thorns = np.array([False] + [hasattr(enemy, 'thorns_damage')
+                                          for enemy in battle_enemies])
+    self.max_hp = float(player.stats[battle_engine.MAX_HP])
+
+    # Same key as battle_engine.InitiativeQueue; no one spawns, so the order
+    # is fixed for the whole battle.
+    self.order = np.array(sorted(
+        range(self.num_actors),
+        key=lambda index: (-actors[index].stats.values[
+            battle_engine.SPEED_INDEX], actors[index].name, index)))
+
+    # ThresholdPolicy never casts anything else.
+    heals = [ability for ability in player.abilities
+             if type(ability) is abilities.Heal]
+    flames = [ability for ability in player.abilities
+              if type(ability) is abilities.AreaFlames]
+    # Biggest first; ties keep list order, like max().
+    self.heals = sorted(heals, key=lambda ability: -ability.amount)
+    self.flames = sorted(flames, key=lambda ability: -ability.amount)
+
+    self.aura_owners = []
+    aura_adds = []
+    aura_mults = []
+    durations = []
+    for owner, actor in enumerate(actors):
+      for aura in actor.auras:
+        add = np.zeros(battle_engine.NUM_STATS)
+        mult = np.ones(battle_engine.NUM_STATS)
+        for index, value in aura.effects:
+          add[index] += value
+          mult[index] *= value
+        self.aura_owners.append(owner)
+        aura_adds.append(add)
+        aura_mults.append(mult)
+        durations.append(aura.duration)
+    self.aura_owners = np.array(self.aura_owners, dtype=int)
+    self.aura_adds = np.array(aura_adds).reshape(-1, battle_engine.NUM_STATS)
+    self.aura_mults = np.array(aura_mults).reshape(-1, battle_engine.NUM_STATS)
+
+    m = num_battles
+    self.hp = np.tile(np.array([actor.hp for actor in actors], dtype=float),
+                      (m, 1))
+    self.alive = self.hp > 0
+    self.mana = np.full(m, float(player.mana))
+    self.potions = np.full(m, len(player.inventory))
+    self.action_points = np.zeros(m, dtype=int)
+    self.in_turn = np.zeros(m, dtype=bool)
+    self.turn = np.zeros(m, dtype=int)
+    self.rounds = np.ones(m, dtype=int)
+    self.done = np.zeros(m, dtype=bool)
+    self.won = np.zeros(m, dtype=bool)
+    self.durations = np.tile(np.array(durations, dtype=int), (m, 1))
+    self.aura_sums = np.zeros((m, self.num_actors, battle_engine.NUM_STATS))
+    self.aura_products = np.ones((m, self.num_actors,
+                                  battle_engine.NUM_STATS))
+    self.update_aura_aggregates()
+
+  def update_aura_aggregates(self):
+    """Refold active auras in list order, as `Actor.rebuild_aura_effects`."""
+    self.aura_sums[:] = 0
+    self.aura_products[:] = 1
+    for k, owner in enumerate(self.aura_owners):
+      active = self.durations[:, k, None] > 0
+      self.aura_sums[:, owner] += np.where(active, self.aura_adds[k], 0)
+      self.aura_products[:, owner] *= np.where(active, self.aura_mults[k], 1)
+
+  def get_armor(self, battles, actor, damage_type):
+    index = battle_engine.ARMOR_INDEX[damage_type]
+    return self.stats[actor, index] + self.aura_sums[battles, actor, index]
+
+  def get_received_damage_multiplier(self, battles, actor, damage_type):
+    index = battle_engine.RECEIVED_DAMAGE_MULTIPLIER_INDEX[damage_type]
+    return self.aura_products[battles, actor, index]
+
+  def attack_damage(self, battles, attacker, defender):
+    """Non-crit damage of standard attacks, as `Actor.attack_target`."""
+    total = 0
+    stats = self.stats
+    sums = self.aura_sums
+    products = self.aura_products
+    for type_index, damage_type in enumerate(battle_engine.DAMAGE_TYPES):
+      base = self.base_damage[attacker, type_index]
+      index = battle_engine.POWER_INDEX[damage_type]
+      power = stats[attacker, index] + sums[battles, attacker, index]
+      base = np.where(self.tags[attacker, type_index], base + power, base)
+      index = battle_engine.STRENGTH_INDEX[damage_type]
+      strength = stats[attacker, index] * products[battles, attacker, index]
+      index = battle_engine.RESISTANCE_INDEX[damage_type]
+      resistance = stats[defender, index] * products[battles, defender, index]
+      damage_bonus = sums[battles, attacker,
+                          battle_engine.DAMAGE_BONUS_INDEX[damage_type]]
+      armor = self.get_armor(battles, defender, damage_type)
+      damage_mult = products[battles, attacker,
+                             battle_engine.DAMAGE_MULTIPLIER_INDEX[damage_type]]
+      received_mult = self.get_received_damage_multiplier(battles, defender,
+                                                          damage_type)
+      total = total + compute_damage(base, strength, resistance, damage_bonus,
+                                     armor, damage_mult, received_mult)
+    return total
+
+  def attack(self, battles, attacker, defender):
+    damage = self.attack_damage(battles, attacker, defender)
+    crit = self.rng.random(len(battles)) < battle_engine.CRIT_PROBABILITY
+    damage = np.round(damage * np.where(crit, battle_engine.CRIT_MULTIPLIER, 1))
+    self.take_damage(battles, defender, damage)
+
+  def take_damage(self, battles, actor, damage):
+    hp = np.maximum(self.hp[battles, actor] - damage, 0)
+    self.hp[battles, actor] = hp
+    self.alive[battles, actor] = hp > 0
+
+  def heal(self, battles, amount):
+    self.hp[battles, PLAYER] = np.minimum(self.hp[battles, PLAYER] + amount,
+                                          self.max_hp)
+
+  def decrement_auras(self, battles, actor):
+    if not len(battles):
+      return
+    owned = np.nonzero(self.aura_owners == actor)[0]
+    if not len(owned):
+      return
+    durations = self.durations[battles[:, None], owned]
+    expired = (durations == 1).any()
+    self.durations[battles[:, None], owned] = np.maximum(durations - 1, 0)
+    if expired:
+      self.update_aura_aggregates()
+
+  def end_turn(self, battles):
+    """Finish the current actor's turn and check for the end of battle."""
+    players_dead = ~self.alive[battles, PLAYER]
+    enemies_dead = ~self.alive[battles, 1:].any(axis=1)
+    over = players_dead | enemies_dead
+    self.done[battles[over]] = True
+    self.won[battles[over]] = enemies_dead[over] & ~players_dead[over]
+    battles = battles[~over]
+    self.turn[battles] += 1
+    wrapped = battles[self.turn[battles] == self.num_actors]
+    self.turn[wrapped] = 0
+    capped = wrapped[self.rounds[wrapped] >= self.max_rounds]
+    self.done[capped] = True
+    self.rounds[wrapped] += self.rounds[wrapped] < self.max_rounds
+
+  def step(self):
+    """Perform one action in every unfinished battle."""
+    battles = np.nonzero(~self.done)[0]
+    current = self.order[self.turn[battles]]
+    current_alive = self.alive[battles, current]
+    # Dead actors lose their turn.
+    self.end_turn(battles[~current_alive])
+    for actor in range(1, self.num_actors):
+      self.enemy_turn(battles[current_alive & (current == actor)], actor)
+    self.player_action(battles[current_alive & (current == PLAYER)])
+
+  def enemy_turn(self, battles, actor):
+    if not len(battles):
+      return
+    self.attack(battles, actor, PLAYER)
+    self.decrement_auras(battles, actor)
+    self.end_turn(battles)
+
+  def choose_actions(self, battles):
+    """Vectorized `ThresholdPolicy.plan_action`; returns (codes, abilities)."""
+    policy = self.policy
+    hp = self.hp[battles, PLAYER]
+    action_points = self.action_points[battles]
+    mana = self.mana[battles]
+    num_enemies = self.alive[battles, 1:].sum(axis=1)
+    codes = np.full(len(battles), END_TURN)
+    choice = np.full(len(battles), -1)
+    undecided = np.ones(len(battles), dtype=bool)
+
+    def decide(mask, code, ability=-1):
+      mask = mask & undecided
+      codes[mask] = code
+      choice[mask] = ability
+      undecided[mask] = False
+
+    decide((hp <= policy.potion_below) & (self.potions[battles] > 0) &
+           (action_points >= battle_engine.ACTION_COST[battle_engine.ITEM]),
+           POTION)
+    for index, heal in enumerate(self.heals):
+      decide((hp <= policy.heal_below) & (action_points >= heal.ap_cost) &
+             (mana >= heal.mana_cost), HEAL, index)
+    for index, flames in enumerate(self.flames):
+      decide((num_enemies >= policy.flames_min_enemies) &
+             (action_points >= flames.ap_cost) & (mana >= flames.mana_cost),
+             FLAMES, index)
+    decide(action_points >= battle_engine.ACTION_COST[battle_engine.ATTACK],
+           ATTACK)
+    return codes, choice
+
+  def player_action(self, battles):
+    if not len(battles):
+      return
+    starting = battles[~self.in_turn[battles]]
+    self.action_points[starting] = battle_engine.MAX_ACTION_POINTS
+    self.in_turn[starting] = True
+
+    codes, choice = self.choose_actions(battles)
+    cost = np.zeros(len(battles), dtype=int)
+
+    attacking = codes == ATTACK
+    if attacking.any():
+      targets = self.first_living_enemy(battles[attacking])
+      self.attack(battles[attacking], PLAYER, targets)
+      for target in np.unique(targets):
+        if self.has_thorns[target]:
+          thorny = battles[attacking][targets == target]
+          thorns = np.round(compute_damage(
+              0, 0, 1, self.thorns[target],
+              self.get_armor(thorny, PLAYER, battle_engine.PHYSICAL), 1,
+              self.get_received_damage_multiplier(
+                  thorny, PLAYER, battle_engine.PHYSICAL)))
+          self.take_damage(thorny, PLAYER, thorns)
+      cost[attacking] = battle_engine.ACTION_COST[battle_engine.ATTACK]
+
+    drinking = codes == POTION
+    self.heal(battles[drinking], POTION_AMOUNT)
+    self.potions[battles[drinking]] -= 1
+    cost[drinking] = battle_engine.ACTION_COST[battle_engine.ITEM]
+
+    for index, heal in enumerate(self.heals):
+      healing = (codes == HEAL) & (choice == index)
+      self.heal(battles[healing], heal.amount)
+      self.mana[battles[healing]] -= heal.mana_cost
+      cost[healing] = heal.ap_cost
+
+    for index, flames in enumerate(self.flames):
+      casting = battles[(codes == FLAMES) & (choice == index)]
+      for enemy in range(1, self.num_actors):
+        hit = casting[self.alive[casting, enemy]]
+        damage = compute_damage(
+            0, 0, 1, flames.amount,
+            self.get_armor(hit, enemy, battle_engine.SPECIAL), 1,
+            self.get_received_damage_multiplier(hit, enemy,
+                                                battle_engine.SPECIAL))
+        self.take_damage(hit, enemy, damage)
+      self.mana[casting] -= flames.mana_cost
+      cost[(codes == FLAMES) & (choice == index)] = flames.ap_cost
+
+    cost[codes == END_TURN] = battle_engine.MAX_ACTION_POINTS
+    self.action_points[battles] -= cost
+
+    finished = ((self.action_points[battles] <= 0) |
+                ~self.alive[battles, PLAYER] |
+                ~self.alive[battles, 1:].any(axis=1))
+    finished = battles[finished]
+    self.decrement_auras(finished, PLAYER)
+    self.in_turn[finished] = False
+    self.end_turn(finished)
+
+  def first_living_enemy(self, battles):
+    return 1 + np.argmax(self.alive[battles, 1:], axis=1)
+
+  def run(self):
+    """Play every battle out; return per-battle (won, rounds, hp left)."""
+    while not self.done.all():
+      self.step()
+    return self.won, self.rounds, self.hp[:, PLAYER]
+
+
+def check_supported(player, battle_enemies):
+  """Raise ValueError unless the batch engine can run this battle."""
+  for item in player.inventory:
+    if type(item) is not items.Potion:
+      raise ValueError('Unsupported item %r' % item)
+  for enemy in battle_enemies:
+    if type(enemy).take_turn is not battle_engine.Enemy.take_turn:
+      raise ValueError('%s does not use standard attacks' % enemy.name)
+    if type(enemy).respond_to_attack not in (
+        battle_engine.Actor.respond_to_attack,
+        enemies.HornDog.respond_to_attack):
+      raise ValueError('Unsupported attack response of %s' % enemy.name)
+
+
+def default_battle():
+  """A small encounter in the supported subset, for checks and benchmarks."""
+  player = create_character.create_character(
+      'Anzacel', simulate.find_cells(['Max HP +2', 'Physical Power +1']),
+      [items.Potion(), items.Potion()])
+  player.abilities = [abilities.Heal(2), abilities.AreaFlames(1)]
+  return battle_engine.Battle(
+      [player], [enemies.HornDog(), enemies.LilBug(), enemies.LilBug()])
+
+
+def tally(won, rounds, hp_left):
+  result = simulate.Tally()
+  result.battles = len(won)
+  result.wins = int(np.sum(won))
+  result.rounds = int(np.sum(rounds))
+  result.hp_left = float(np.sum(hp_left))
+  return result
+
+
+def run_object_engine(make_battle, policy, num_battles, seed,
+                      max_rounds=simulate.DEFAULT_MAX_ROUNDS):
+  """Play `num_battles` fresh battles from `make_battle` headless.
+
+  Returns per-battle (won, rounds, hp left) arrays like `BatchBattle.run`.
+  """
+  results = []
+  previous_policy = battle_engine.set_decision_policy(policy)
+  previous_sink = simulate.events.set_sink(simulate.events.NullSink())
+  try:
+    for index in range(num_battles):
+      simulate.seed_battle(seed, index)
+      battle = make_battle()
+      player = battle.players[0]
+      policy.reset()
+      won, rounds = simulate.run_battle(battle, max_rounds)
+      results.append((won, rounds, player.hp))
+  finally:
+    battle_engine.set_decision_policy(previous_policy)
+    simulate.events.set_sink(previous_sink)
+  return tuple(np.array(column) for column in zip(*results))
+
+
+def check_equivalence(make_battle=default_battle, policy=None,
+                      num_battles=4000, seed=0, max_sigma=4):
+  """Check the batch engine's outcomes against the object engine's.
+
+  Win rate, mean rounds and mean hp left must agree within `max_sigma`
+  standard errors. Returns both tallies; raises AssertionError otherwise.
+  """
+  policy = policy or ThresholdPolicy()
+  expected = run_object_engine(make_battle, policy, num_battles, seed)
+  battle = make_battle()
+  actual = BatchBattle(battle.players[0], battle.enemies, num_battles, policy,
+                       seed).run()
+
+  names = ['win rate', 'mean rounds', 'mean hp left']
+  for name, object_values, batch_values in zip(names, expected, actual):
+    object_values = np.asarray(object_values, dtype=float)
+    batch_values = np.asarray(batch_values, dtype=float)
+    error = math.sqrt((object_values.var() + batch_values.var()) /
+                      num_battles)
+    difference = abs(object_values.mean() - batch_values.mean())
+    if difference > max_sigma * error:
+      raise AssertionError('%s differs: %.4f vs %.4f (standard error %.4f)' %
+                           (name, object_values.mean(), batch_values.mean(),
+                            error))
+  return tally(*expected), tally(*actual)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--battles', type=int, default=4000)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  expected, actual = check_equivalence(num_battles=args.battles,
+                                       seed=args.seed)
+  print('object engine: %r' % expected)
+  print('batch engine:  %r' % actual)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,22 @@
+import array
+import bisect
 import collections
+import collections.abc
+import contextlib
+import heapq
 import random
 
+import events
+import profiling
+
 MAX_ACTION_POINTS = 3
 
 CRIT_PROBABILITY = 1/8
 CRIT_MULTIPLIER = 2
+# Targets an actor remembers resolved attack damages for.
+MAX_DAMAGE_PAIRS = 64
+# Entries in each of the damage tables shared between battles.
+MAX_DAMAGE_TABLE = 4096
 
 # Placeholder stat system: multipliers are `STAT_EXPONENT_BASE ** stat_value`.
 STAT_EXPONENT_BASE = 1.1
@@ -33,6 +45,30 @@ RECEIVED_DAMAGE_MULTIPLIER = 'receieved_damage_multiplier'
 ADD = 'add'
 MULT = 'mult'
 
+# Every stat and aura-affected quantity has a fixed slot in stat vectors.
+STAT_KEYS = [MAX_HP, MAX_MANA, SPEED] + [
+    (damage_type, quantity)
+    for damage_type in DAMAGE_TYPES
+    for quantity in [POWER, STRENGTH, RESISTANCE, ARMOR, DAMAGE_BONUS,
+                     DAMAGE_MULTIPLIER, RECEIVED_DAMAGE_MULTIPLIER]]
+STAT_INDEX = {key: index for index, key in enumerate(STAT_KEYS)}
+NUM_STATS = len(STAT_KEYS)
+
+
+def _stat_indices(quantity):
+  return {damage_type: STAT_INDEX[(damage_type, quantity)]
+          for damage_type in DAMAGE_TYPES}
+
+
+SPEED_INDEX = STAT_INDEX[SPEED]
+POWER_INDEX = _stat_indices(POWER)
+STRENGTH_INDEX = _stat_indices(STRENGTH)
+RESISTANCE_INDEX = _stat_indices(RESISTANCE)
+ARMOR_INDEX = _stat_indices(ARMOR)
+DAMAGE_BONUS_INDEX = _stat_indices(DAMAGE_BONUS)
+DAMAGE_MULTIPLIER_INDEX = _stat_indices(DAMAGE_MULTIPLIER)
+RECEIVED_DAMAGE_MULTIPLIER_INDEX = _stat_indices(RECEIVED_DAMAGE_MULTIPLIER)
+
 # Actions
 ATTACK = 'attack'
 ABILITY = 'ability'
@@ -50,137 +86,472 @@ ACTION_COST = {
 }
 BACK = 'back'
 
+# One available action with every choice `Player.take_action` asks for made:
+# the attack, item or interaction `target`, the `item` used and the
+# `ability` used, None where they do not apply. Choices an ability makes
+# once used (e.g. Pray's options) are not part of the move.
+Move = collections.namedtuple('Move', ['action', 'target', 'item', 'ability'])
+
+# Object answering `choose_option` calls in place of a human at the keyboard.
+# It must provide `start_turn(actor, battle)` and `choose(options)`; see
+# `simulate.Policy`. None means prompt on stdin.
+decision_policy = None
+
+
+def stat_index(key):
+  try:
+    return STAT_INDEX[key]
+  except KeyError:
+    raise KeyError('Unknown stat %r' % (key,)) from None
+
+
+class BattleContext():
+  """The RNGs, event sink, decision policy and profiler of one battle.
+
+  A battle hands its context to every actor that joins it, and the engine
+  takes randomness, events and decisions from there. Battles with contexts
+  of their own share no mutable state but the damage tables, which only
+  memoize pure functions of their keys, so they can run in parallel threads.
+  `rng` is a `random.Random`; `np_rng`, a `numpy.random.RandomState`, is
+  seeded from `rng` on first use unless given. `decisions` is as for
+  `set_decision_policy`, None meaning the console.
+  """
+  def __init__(self, rng=None, np_rng=None, sink=None, decisions=None,
+               profiler=None):
+    self.rng = random.Random() if rng is None else rng
+    self._np_rng = np_rng
+    self.sink = events.NullSink() if sink is None else sink
+    self.decisions = decisions
+    self.profiler = profiler
+
+  @property
+  def np_rng(self):
+    if self._np_rng is None:
+      import numpy as np
+      self._np_rng = np.random.RandomState(self.rng.getrandbits(32))
+    return self._np_rng
+
+  def choose(self, options, back=False):
+    """Ask the decision policy, or the console, for one of `options`."""
+    if back:
+      options = options + [BACK]
+    decisions = self.decisions
+    if decisions is not None:
+      return decisions.choose(options)
+    return options[prompt_choice(options)]
+
+  def say(self, text):
+    sink = self.sink
+    if sink.enabled:
+      sink.emit(events.Message(text))
+
+
+class GlobalContext(BattleContext):
+  """The process-wide RNGs, sink, decision policy and profiler.
+
+  Battles created without a context use this one. Its attributes follow the
+  `random` and `numpy.random` modules, `events.sink`, `decision_policy` and
+  `profiling.profiler`, and setting them sets those.
+  """
+  def __init__(self):
+    pass
+
+  rng = random
+
+  @property
+  def np_rng(self):
+    import numpy as np
+    return np.random
+
+  @property
+  def sink(self):
+    return events.sink
+
+  @sink.setter
+  def sink(self, sink):
+    events.set_sink(sink)
+
+  @property
+  def decisions(self):
+    return decision_policy
+
+  @decisions.setter
+  def decisions(self, decisions):
+    set_decision_policy(decisions)
+
+  @property
+  def profiler(self):
+    return profiling.profiler
+
+  @profiler.setter
+  def profiler(self, profiler):
+    profiling.set_profiler(profiler)
+
+
+global_context = GlobalContext()
+
+
+class StatBlock(collections.abc.MutableMapping):
+  """Stats stored in a flat array, one slot per entry of `STAT_KEYS`.
+
+  Behaves like the dict it was built from; hot paths read `values` directly.
+  `version` is bumped by every change made through the mapping interface.
+  """
+  __slots__ = ('values', 'present', 'version')
+
+  def __init__(self, stat_dict=()):
+    self.values = array.array('d', bytes(8 * NUM_STATS))
+    # Bit i is set when STAT_KEYS[i] has been assigned.
+    self.present = 0
+    self.version = 0
+    self.update(stat_dict)
+
+  def __getitem__(self, key):
+    index = stat_index(key)
+    if not self.present >> index & 1:
+      raise KeyError(key)
+    value = self.values[index]
+    # Stats given as ints read back as ints.
+    return int(value) if value.is_integer() else value
+
+  def __setitem__(self, key, value):
+    index = stat_index(key)
+    self.values[index] = value
+    self.present |= 1 << index
+    self.version += 1
+
+  def __delitem__(self, key):
+    index = stat_index(key)
+    if not self.present >> index & 1:
+      raise KeyError(key)
+    self.values[index] = 0
+    self.present &= ~(1 << index)
+    self.version += 1
+
+  def __iter__(self):
+    return (key for index, key in enumerate(STAT_KEYS)
+            if self.present >> index & 1)
+
+  def __len__(self):
+    return bin(self.present).count('1')
+
+  def copy(self):
+    return StatBlock(self)
+
+  def __repr__(self):
+    return repr(dict(self))
+
 
 class Actor():
+  """Something that fights in battles.
+
+  The stat getters used by attacks are compiled into `offense` and `defense`
+  bundles, which are dropped whenever auras (or a player's equipment) change.
+  """
+  __slots__ = ('name', 'hp', 'alive', 'stats', 'auras', 'aura_sums',
+               'aura_products', 'registry', 'actor_id', 'context', 'offense',
+               'defense')
+
   def __init__(self, name, stat_dict, auras=None):
     self.name = name
 
     self.hp = stat_dict[MAX_HP]
     self.alive = True
+    # Set by the ActorRegistry of the battle the actor is fighting in.
+    self.registry = None
+    self.actor_id = None
+    self.context = global_context
 
-    self.stats = stat_dict
+    self.stats = StatBlock(stat_dict)
 
     if auras is None:
       self.auras = []
     else:
       self.auras = auras
+    self.rebuild_aura_effects()
 
   def take_damage(self, damage):
     self.hp -= damage
     self.hp = max(self.hp, 0)
-    print('%s has %d hp remaining.' % (self.name, self.hp))
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Damage(self, damage, self.hp))
     if self.hp <= 0:
       self.die()
 
   def heal(self, amount):
     self.hp += amount
     self.hp = min(self.hp, self.stats[MAX_HP])
-    print('%s has %d hp remaining.' % (self.name, self.hp))
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Heal(self, amount, self.hp))
 
   def __repr__(self):
     return self.name
 
   def attack_target(self, target, attack_tags):
-    phys_damage = self.get_attack_damage(target, PHYSICAL, attack_tags)
-    sp_damage = self.get_attack_damage(target, SPECIAL, attack_tags)
-    crit = random.random() < CRIT_PROBABILITY
-    crit_multiplier = CRIT_MULTIPLIER if crit else 1
-
-    damage = round((phys_damage + sp_damage) * crit_multiplier)
-
-    print('%s attacked %s.' % (self.name, target.name))
-    if crit:
-      print('Critical hit!')
-    print('%s took %d damage.' % (target.name, damage))
+    context = self.context
+    profiler = context.profiler
+    if profiler is not None:
+      start = profiler.clock()
+    resolved = self.resolve_attack(target, attack_tags)
+    crit = context.rng.random() < CRIT_PROBABILITY
+    damage = resolved[4] if crit else resolved[3]
+    if profiler is not None:
+      profiler.record(profiling.DAMAGE, type(self), start)
+
+    sink = context.sink
+    if sink.enabled:
+      sink.emit(events.Attack(self, target, damage, crit))
 
     target.take_damage(damage)
     target.respond_to_attack(self)
 
   def get_attack_damage(self, target, damage_type, attack_tags=()):
-    base_damage = self.get_base_damage(damage_type)
-
-    if damage_type in attack_tags:
-      # Only add user's power if weapon deals corresponding damage type.
-      base_damage += self.get_power(damage_type)
-
-    attack_mult = self.get_strength(damage_type)
-    def_mult = target.get_resistance(damage_type)
-    damage_bonus = self.get_damage_bonus(damage_type)
-    def_bonus = target.get_armor(damage_type)
-    atk_damage_mult = self.get_damage_multiplier(damage_type)
-    def_damage_mult = target.get_received_damage_multiplier(damage_type)
-
-    return compute_damage(
-        base_damage, attack_mult, def_mult, damage_bonus, def_bonus,
-        atk_damage_mult, def_damage_mult)
+    damages = self.get_attack_damages(target, attack_tags)
+    return damages[DAMAGE_TYPES.index(damage_type)]
+
+  def get_attack_damages(self, target, attack_tags=()):
+    """Non-crit damage to `target`, per entry of `DAMAGE_TYPES`."""
+    return self.resolve_attack(target, attack_tags)[2]
+
+  def resolve_attack(self, target, attack_tags):
+    """Resolve an attack on `target`, before the crit roll.
+
+    Returns (target's defense, attack tags, damages per entry of
+    `DAMAGE_TYPES`, damage dealt, damage dealt by a crit). Resolved once
+    per target from this actor's offense and the target's defense, then
+    looked up until either is recompiled. Attacks between
+    aura-free actors are also kept in `attack_table`, so a build fighting
+    an enemy class resolves each attack once across battles.
+    """
+    offense = self.get_offense()
+    defense = target.get_defense()
+    pairs = offense[1]
+    # Keyed by id, so that dead targets are not kept alive. An entry left by
+    # a dead target whose id was reused fails the defense check.
+    resolved = pairs.get(id(target))
+    if (resolved is not None and resolved[0] is defense and
+        resolved[1] == attack_tags):
+      return resolved
+    shared = offense[2] and defense[2]
+    outcome = None
+    if shared:
+      key = (offense[3:], defense[3:], tuple(attack_tags))
+      outcome = attack_table.get(key)
+    if outcome is None:
+      damages = tuple(
+          resolve_damage(attack, defend, damage_type in attack_tags)
+          for damage_type, attack, defend
+          in zip(DAMAGE_TYPES, offense[3:], defense[3:]))
+      total = sum(damages)
+      outcome = (damages, round(total), round(total * CRIT_MULTIPLIER))
+      if shared:
+        remember(attack_table, key, outcome)
+    resolved = (defense, attack_tags) + outcome
+    remember(pairs, id(target), resolved, MAX_DAMAGE_PAIRS)
+    return resolved
+
+  def get_fixed_damage(self, damage_bonus, damage_type):
+    """Damage a flat `damage_bonus` of `damage_type` deals to this actor.
+
+    Thorns and area flames hit this way, ignoring the user's stats and this
+    actor's resistance. Cached like attacks in `resolve_attack`.
+    """
+    defense = self.get_defense()
+    key = (damage_bonus, damage_type)
+    damage = defense[1].get(key)
+    if damage is not None:
+      return damage
+    shared = defense[2]
+    if shared:
+      shared_key = (defense[3:], damage_bonus, damage_type)
+      damage = fixed_damage_table.get(shared_key)
+    if damage is None:
+      _, armor, received_damage_mult = defense[3 + DAMAGE_TYPES.index(
+          damage_type)]
+      damage = compute_damage(0, 0, 1, damage_bonus, armor, 1,
+                              received_damage_mult)
+      if shared:
+        remember(fixed_damage_table, shared_key, damage)
+    defense[1][key] = damage
+    return damage
+
+  def get_offense(self):
+    offense = self.offense
+    if offense is None or offense[0] != self.stats.version:
+      offense = self.compile_offense()
+    return offense
+
+  def get_defense(self):
+    defense = self.defense
+    if defense is None or defense[0] != self.stats.version:
+      defense = self.compile_defense()
+    return defense
+
+  def compile_offense(self):
+    """Compile and return the attacking half of `resolve_attack`.
+
+    (stats version, resolved attacks by target id, whether aura-free, then per
+    damage type the base damage, power, strength, damage bonus and damage
+    multiplier).
+    """
+    self.offense = (self.stats.version, {}, not self.auras) + tuple(
+        (self.get_base_damage(damage_type), self.get_power(damage_type),
+         self.get_strength(damage_type), self.get_damage_bonus(damage_type),
+         self.get_damage_multiplier(damage_type))
+        for damage_type in DAMAGE_TYPES)
+    return self.offense
+
+  def compile_defense(self):
+    """Compile and return the defending half of `resolve_attack`.
+
+    (stats version, fixed damages, whether aura-free, then per damage type
+    the resistance, armor and received damage multiplier).
+    """
+    self.defense = (self.stats.version, {}, not self.auras) + tuple(
+        (self.get_resistance(damage_type), self.get_armor(damage_type),
+         self.get_received_damage_multiplier(damage_type))
+        for damage_type in DAMAGE_TYPES)
+    return self.defense
+
+  def forget_damage(self):
+    """Drop the compiled offense and defense, e.g. after auras change."""
+    self.offense = None
+    self.defense = None
 
   def get_base_damage(self, damage_type):
     raise NotImplementedError
 
   def get_power(self, damage_type):
-    stat = self.stats[(damage_type, POWER)]
-    aura_effect = self.get_aura_effect((damage_type, POWER), ADD)
-    return stat + aura_effect
+    index = POWER_INDEX[damage_type]
+    return self.stats.values[index] + self.aura_sums[index]
 
   def get_strength(self, damage_type):
-    stat = self.stats[(damage_type, STRENGTH)]
-    aura_effect = self.get_aura_effect((damage_type, STRENGTH), MULT)
-    return stat * aura_effect
+    index = STRENGTH_INDEX[damage_type]
+    return self.stats.values[index] * self.aura_products[index]
 
   def get_resistance(self, damage_type):
-    stat = self.stats[(damage_type, RESISTANCE)]
-    aura_effect = self.get_aura_effect((damage_type, RESISTANCE), MULT)
-    return stat * aura_effect
+    index = RESISTANCE_INDEX[damage_type]
+    return self.stats.values[index] * self.aura_products[index]
 
   def get_damage_bonus(self, damage_type):
-    return self.get_aura_effect((damage_type, DAMAGE_BONUS), ADD)
+    return self.aura_sums[DAMAGE_BONUS_INDEX[damage_type]]
 
   def get_armor(self, damage_type):
-    stat = self.stats[(damage_type, ARMOR)]
-    aura_effect = self.get_aura_effect((damage_type, ARMOR), ADD)
-    return stat + aura_effect
+    index = ARMOR_INDEX[damage_type]
+    return self.stats.values[index] + self.aura_sums[index]
 
   def get_damage_multiplier(self, damage_type):
-    return self.get_aura_effect((damage_type, DAMAGE_MULTIPLIER), MULT)
+    return self.aura_products[DAMAGE_MULTIPLIER_INDEX[damage_type]]
 
   def get_received_damage_multiplier(self, damage_type):
-    return self.get_aura_effect((damage_type, RECEIVED_DAMAGE_MULTIPLIER), MULT)
+    return self.aura_products[RECEIVED_DAMAGE_MULTIPLIER_INDEX[damage_type]]
 
   def take_turn(self, battle):
     raise NotImplementedError
 
+  def mark_dead(self):
+    self.alive = False
+    if self.registry is not None:
+      self.registry.report_death(self)
+
+  def snapshot(self):
+    """Return an immutable record of the state a battle can change."""
+    return (self.hp, self.alive,
+            tuple((aura, aura.duration) for aura in self.auras),
+            self.aura_sums[:], self.aura_products[:])
+
+  def restore(self, state):
+    """Return to a state recorded by `snapshot`."""
+    self.hp, self.alive, auras, aura_sums, aura_products = state[:5]
+    self.auras = []
+    for aura, duration in auras:
+      aura.duration = duration
+      self.auras.append(aura)
+    self.aura_sums = aura_sums[:]
+    self.aura_products = aura_products[:]
+    self.forget_damage()
+
+  def state_key(self):
+    """Hashable description of the actor's state, independent of identity."""
+    return (type(self).__name__, self.name, self.hp,
+            tuple((aura.name, aura.effects, aura.duration)
+                  for aura in self.auras))
+
   def respond_to_attack(self, attacker):
     pass
 
   def decrement_auras(self):
+    profiler = self.context.profiler
+    if profiler is not None:
+      start = profiler.clock()
     auras = []
     for aura in self.auras:
       aura.duration -= 1
       if aura.duration > 0:
         auras.append(aura)
       else:
-        print('%s wore off of %s' % (aura.name, self.name))
-    self.auras = auras
+        sink = self.context.sink
+        if sink.enabled:
+          sink.emit(events.AuraExpired(self, aura))
+    if len(auras) != len(self.auras):
+      self.auras = auras
+      self.rebuild_aura_effects()
+    if profiler is not None:
+      profiler.record(profiling.AURAS, type(self), start)
+
+  def add_aura(self, aura):
+    """Apply `aura`. Always use this rather than appending to `auras`."""
+    self.auras.append(aura)
+    for index, value in aura.effects:
+      self.aura_sums[index] += value
+      self.aura_products[index] *= value
+    self.forget_damage()
+
+  def remove_aura(self, aura):
+    self.auras.remove(aura)
+    self.rebuild_aura_effects()
+
+  @contextlib.contextmanager
+  def trial_aura(self, aura):
+    """Apply `aura` inside the block, then put back the previous auras.
+
+    Cheaper than `add_aura` then `remove_aura`, as compiled damage survives.
+    """
+    saved = (self.auras[:], self.aura_sums[:], self.aura_products[:],
+             self.offense, self.defense)
+    self.add_aura(aura)
+    try:
+      yield
+    finally:
+      (self.auras, self.aura_sums, self.aura_products, self.offense,
+       self.defense) = saved
+
+  def rebuild_aura_effects(self):
+    """Recompute the per-key aura aggregates from `auras`."""
+    auras = self.auras
+    self.auras = []
+    self.aura_sums = array.array('d', bytes(8 * NUM_STATS))
+    self.aura_products = array.array('d', [1]) * NUM_STATS
+    self.forget_damage()
+    for aura in auras:
+      self.add_aura(aura)
 
   def get_aura_effect(self, key, aggregation_method):
     if aggregation_method == ADD:
-      effect = 0
+      return self.aura_sums[stat_index(key)]
     elif aggregation_method == MULT:
-      effect = 1
+      return self.aura_products[stat_index(key)]
     else:
       raise ValueError('Invalid aggregation method %s' % aggregation_method)
-    for aura in self.auras:
-      if aura.effects_dict[key] is not None:
-        if aggregation_method == ADD:
-          effect += aura.effects_dict[key]
-        elif aggregation_method == MULT:
-          effect *= aura.effects_dict[key]
-    return effect
 
 
 class Enemy(Actor):
+  __slots__ = ()
+
   def take_turn(self, battle):
-    target = random.choice(battle.players)
+    target = self.context.rng.choice(battle.players)
     self.attack_target(target, self.get_standard_attack_tags())
     self.decrement_auras()
 
@@ -201,11 +572,47 @@ class Enemy(Actor):
     return [PHYSICAL, SPECIAL]
 
   def die(self):
-    self.alive = False
-    print('%s was destroyed' % self.name)
+    self.mark_dead()
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Death(self, 'destroyed'))
+
+
+class Inventory(list):
+  """A player's items, with a `version` bumped by every change."""
+  __slots__ = ('version',)
+
+  def __init__(self, items=()):
+    list.__init__(self, items)
+    self.version = 0
+
+  def __reduce__(self):
+    return Inventory, (list(self),)
+
+
+def _bump_version(method):
+  def bumped(self, *args, **kwargs):
+    self.version += 1
+    return method(self, *args, **kwargs)
+  bumped.__name__ = method.__name__
+  return bumped
+
+
+for _method in (list.append, list.extend, list.insert, list.remove, list.pop,
+                list.clear, list.sort, list.reverse, list.__setitem__,
+                list.__delitem__, list.__iadd__, list.__imul__):
+  setattr(Inventory, _method.__name__, _bump_version(_method))
 
 
 class Player(Actor):
+  """A player-controlled actor.
+
+  Available actions and moves are cached until `legal_key` changes, so the
+  `abilities` list must not change while the player is in a battle.
+  """
+  __slots__ = ('mana', '_inventory', 'abilities', '_equipped',
+               'action_points', 'action_cache', 'move_cache')
+
   def __init__(self, name, stat_dict, inventory=None, abilities=None,
                equipped=None):
     Actor.__init__(self, name, stat_dict)
@@ -222,14 +629,74 @@ class Player(Actor):
       self.abilities = abilities
     
     self.equipped = equipped
-
-  def get_available_actions(self, battle, action_points, mana):
+    # Action points left in the current turn, for decision policies.
+    self.action_points = 0
+
+  @property
+  def inventory(self):
+    return self._inventory
+
+  @inventory.setter
+  def inventory(self, items):
+    if not isinstance(items, Inventory):
+      items = Inventory(items)
+    self._inventory = items
+    # (legal_key, actions, abilities) and (legal_key, moves). The new
+    # inventory's version may match the old one's, so start afresh.
+    self.action_cache = None
+    self.move_cache = None
+
+  @property
+  def equipped(self):
+    return self._equipped
+
+  @equipped.setter
+  def equipped(self, weapon):
+    self._equipped = weapon
+    self.offense = None
+
+  def snapshot(self):
+    return Actor.snapshot(self) + (self.mana, tuple(self.inventory),
+                                   self.equipped, self.action_points)
+
+  def restore(self, state):
+    Actor.restore(self, state)
+    self.mana, inventory, self.equipped, self.action_points = state[5:]
+    # In place, as policies may hold on to the list.
+    self.inventory[:] = inventory
+
+  def state_key(self):
+    return Actor.state_key(self) + (
+        self.mana, tuple(repr(item) for item in self.inventory),
+        repr(self.equipped), self.action_points)
+
+  def legal_key(self, battle, action_points, mana):
+    """Everything but `abilities` that available actions and moves depend on.
+
+    Registry versions change with the actors on each side, and the inventory
+    version with the items.
+    """
+    registry = battle.registry
+    return (registry, registry.players_version, registry.enemies_version,
+            registry.interactable_version, self._inventory.version,
+            action_points, mana)
+
+  def legal_actions(self, battle, action_points, mana):
+    """Return (available actions, available abilities), cached.
+
+    The lists are shared between calls; treat them as read-only.
+    """
+    key = self.legal_key(battle, action_points, mana)
+    cache = self.action_cache
+    if cache is not None and cache[0] == key:
+      return cache[1], cache[2]
+    abilities = self.get_available_abilities(action_points, mana)
     available_actions = []
     for action in ALL_ACTIONS:
       if action in ACTION_COST and ACTION_COST[action] > action_points:
         continue
       elif action == ABILITY:
-        if self.get_available_abilities(action_points, mana):
+        if abilities:
           available_actions.append(action)
       elif action == ITEM:
         if self.inventory:
@@ -239,20 +706,61 @@ class Player(Actor):
           available_actions.append(action)
       else:
         available_actions.append(action)
-    return available_actions
+    self.action_cache = (key, available_actions, abilities)
+    return available_actions, abilities
+
+  def get_available_actions(self, battle, action_points, mana):
+    return self.legal_actions(battle, action_points, mana)[0]
+
+  def get_legal_moves(self, battle, action_points=None):
+    """Every available action with its choices made, as a list of `Move`s.
+
+    `action_points` defaults to those left this turn. LOOK is left out, as
+    it changes nothing. Cached like `legal_actions`; treat as read-only.
+    """
+    if action_points is None:
+      action_points = self.action_points
+    key = self.legal_key(battle, action_points, self.mana)
+    cache = self.move_cache
+    if cache is not None and cache[0] == key:
+      return cache[1]
+    actions, abilities = self.legal_actions(battle, action_points, self.mana)
+    moves = []
+    for action in actions:
+      if action == ATTACK:
+        moves.extend(Move(action, enemy, None, None)
+                     for enemy in battle.enemies)
+      elif action == ABILITY:
+        moves.extend(Move(action, None, None, ability)
+                     for ability in abilities)
+      elif action == ITEM:
+        for item in self.inventory:
+          moves.extend(Move(action, target, item, None)
+                       for target in item.get_valid_targets(self, battle))
+      elif action == INTERACT:
+        moves.extend(Move(action, target, None, None)
+                     for target in self.get_interaction_targets(battle))
+      elif action == END_TURN:
+        moves.append(Move(action, None, None, None))
+    self.move_cache = (key, moves)
+    return moves
 
   def get_available_abilities(self, action_points, mana):
     return [ability for ability in self.abilities
             if ability.ap_cost <= action_points and ability.mana_cost <= mana]
 
   def take_turn(self, battle):
+    context = self.context
+    if context.decisions is not None:
+      context.decisions.start_turn(self, battle)
     action_points = MAX_ACTION_POINTS
     while action_points > 0:
-      if not battle.enemies or self not in battle.players:
+      if not battle.enemies or not battle.registry.is_player(self):
         break
 
+      self.action_points = action_points
       actions = self.get_available_actions(battle, action_points, self.mana)
-      action = choose_option(actions)
+      action = context.choose(actions)
 
       cost = self.take_action(action, battle, action_points)
       action_points -= cost
@@ -263,40 +771,58 @@ class Player(Actor):
 
   def take_action(self, action, battle, action_points):
     """Take action and return cost."""
+    context = self.context
     if action == ATTACK:
-      target = choose_option(battle.enemies, back=True)
+      target = context.choose(battle.enemies, back=True)
       if target == BACK:
         return 0
       self.attack_target(target, self.get_attack_tags())
       return ACTION_COST[action]
     elif action == ABILITY:
-      abilities = self.get_available_abilities(action_points, self.mana)
-      ability = choose_option(abilities, back=True)
+      abilities = self.legal_actions(battle, action_points, self.mana)[1]
+      ability = context.choose(abilities, back=True)
       if ability == BACK:
         return 0
+      sink = context.sink
+      if sink.enabled:
+        sink.emit(events.AbilityUsed(self, ability))
+      profiler = context.profiler
+      if profiler is not None:
+        start = profiler.clock()
       ability.use(self, battle)
       self.spend_mana(ability.mana_cost)
+      if profiler is not None:
+        profiler.record(profiling.ABILITY, type(ability), start)
       return ability.ap_cost
     elif action == ITEM:
       if self.inventory:
-        item = choose_option(self.inventory, back=True)
+        item = context.choose(self.inventory, back=True)
         if item == BACK:
           return 0
         valid_targets = item.get_valid_targets(self, battle)
         if valid_targets:
-          target = choose_option(valid_targets, back=True)
+          target = context.choose(valid_targets, back=True)
           if target == BACK:
             return 0
+          sink = context.sink
+          if sink.enabled:
+            sink.emit(events.ItemUsed(self, item, target))
+          profiler = context.profiler
+          if profiler is not None:
+            start = profiler.clock()
           item.use(self, target)
+          if profiler is not None:
+            profiler.record(profiling.ITEM, type(item), start)
           return ACTION_COST[action]
         else:
-          print('No valid targets')
+          context.say('No valid targets')
           return 0
       else:
-        print('No items')
+        context.say('No items')
         return 0
     elif action == INTERACT:
-      target = choose_option(self.get_interaction_targets(battle), back=True)
+      target = context.choose(self.get_interaction_targets(battle),
+                              back=True)
       if target == BACK:
         return 0
       self.interact(target)
@@ -309,7 +835,9 @@ class Player(Actor):
 
   def spend_mana(self, cost):
     self.mana -= cost
-    print('%s has %d mana remaining.' % (self.name, self.mana))
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.ManaSpent(self, cost, self.mana))
 
   def get_base_damage(self, damage_type):
     if self.equipped is None:
@@ -332,17 +860,25 @@ class Player(Actor):
     target.react(self)
 
   def get_interaction_targets(self, battle):
-    return [enemy for enemy in battle.enemies if enemy.is_interactable()]
+    return battle.registry.interactable_enemies()
 
   def die(self):
-    self.alive = False
-    print('%s was defeated' % self.name)
+    self.mark_dead()
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Death(self, 'defeated'))
 
 
 class Aura():
+  __slots__ = ('name', 'effects_dict', 'effects', 'duration')
+
   def __init__(self, name, effects_dict, duration=1):
     self.name = name
-    self.effects_dict = collections.defaultdict(lambda: None, effects_dict)
+    self.effects_dict = dict(effects_dict)
+    # (stat index, value) pairs, ready to fold into an actor's aggregates.
+    self.effects = tuple((stat_index(key), value)
+                         for key, value in self.effects_dict.items()
+                         if value is not None)
     self.duration = duration
 
   def __repr__(self):
@@ -350,6 +886,8 @@ class Aura():
 
 
 class Ability():
+  __slots__ = ('name', 'ap_cost', 'mana_cost')
+
   def __init__(self, name, ap_cost, mana_cost):
     self.name = name
     self.ap_cost = ap_cost
@@ -363,6 +901,8 @@ class Ability():
 
 
 class Item():
+  __slots__ = ()
+
   def get_valid_targets(self, user, battle):
     return battle.players + battle.enemies
 
@@ -370,44 +910,304 @@ class Item():
     user.inventory.remove(self)
 
 
+class InitiativeQueue():
+  """Actors still to move this round, fastest first, ties broken by name.
+
+  Actors with equal speed and name keep insertion order, as with a stable
+  sort. Dead actors are not removed eagerly but skipped when popped.
+  """
+  __slots__ = ('heap', 'counter')
+
+  def __init__(self, actors=()):
+    self.counter = 0
+    self.heap = [self.entry(actor) for actor in actors]
+    heapq.heapify(self.heap)
+
+  def entry(self, actor):
+    self.counter += 1
+    return (-actor.stats.values[SPEED_INDEX], actor.name, self.counter, actor)
+
+  def push(self, actor):
+    heapq.heappush(self.heap, self.entry(actor))
+
+  def pop(self):
+    """Remove and return the next living actor, or None if there is none."""
+    heap = self.heap
+    while heap:
+      actor = heapq.heappop(heap)[-1]
+      if actor.alive:
+        return actor
+    return None
+
+  def __bool__(self):
+    heap = self.heap
+    while heap and not heap[0][-1].alive:
+      heapq.heappop(heap)
+    return bool(heap)
+
+  def actors(self):
+    """Living actors in the order they will move."""
+    return [entry[-1] for entry in sorted(self.heap) if entry[-1].alive]
+
+  def snapshot(self):
+    return tuple(self.heap), self.counter
+
+  def restore(self, state):
+    heap, self.counter = state
+    self.heap = list(heap)
+
+
+def _actor_id(actor):
+  return actor.actor_id
+
+
+def _remove_joined(view, actor):
+  """Remove `actor` from `view`, a list of actors in the order they joined.
+
+  IDs are handed out in joining order, so the actor is found by bisection.
+  """
+  index = bisect.bisect_left(view, actor.actor_id, key=_actor_id)
+  if index == len(view) or view[index] is not actor:
+    index = view.index(actor)
+  del view[index]
+
+
+class ActorRegistry():
+  """The actors in one battle, by side, with stable IDs.
+
+  Deaths are reported by the actors themselves and take effect in
+  `remove_dead_actors`. Membership checks are O(1), and the list views are
+  updated in place as actors join and die. The list views are shared; treat
+  them as read-only.
+  """
+  __slots__ = ('by_id', 'players', 'enemies', 'interactable', 'pending_dead',
+               'player_list', 'enemy_list', 'interactable_list',
+               'players_version', 'enemies_version', 'interactable_version',
+               'context')
+
+  def __init__(self, context=None):
+    # Handed to every actor that registers.
+    self.context = global_context if context is None else context
+    self.by_id = []
+    # Living actors on each side, in the order they joined. Dicts are used as
+    # ordered sets.
+    self.players = {}
+    self.enemies = {}
+    self.interactable = {}
+    self.pending_dead = []
+    self.player_list = []
+    self.enemy_list = []
+    self.interactable_list = []
+    # Bumped whenever the corresponding view changes.
+    self.players_version = 0
+    self.enemies_version = 0
+    self.interactable_version = 0
+
+  def register(self, actor):
+    actor.registry = self
+    actor.context = self.context
+    actor.actor_id = len(self.by_id)
+    self.by_id.append(actor)
+
+  def add_player(self, player):
+    self.register(player)
+    self.players[player] = None
+    self.player_list.append(player)
+    self.players_version += 1
+
+  def add_enemy(self, enemy):
+    self.register(enemy)
+    self.enemies[enemy] = None
+    self.enemy_list.append(enemy)
+    self.enemies_version += 1
+    if enemy.is_interactable():
+      self.interactable[enemy] = None
+      self.interactable_list.append(enemy)
+      self.interactable_version += 1
+
+  def get(self, actor_id):
+    return self.by_id[actor_id]
+
+  def is_player(self, actor):
+    return actor in self.players
+
+  def is_enemy(self, actor):
+    return actor in self.enemies
+
+  def report_death(self, actor):
+    self.pending_dead.append(actor)
+
+  def remove_dead_actors(self):
+    dead = self.pending_dead
+    if not dead:
+      return
+    self.pending_dead = []
+    for actor in dead:
+      if actor in self.players:
+        del self.players[actor]
+        _remove_joined(self.player_list, actor)
+        self.players_version += 1
+      if actor in self.enemies:
+        del self.enemies[actor]
+        _remove_joined(self.enemy_list, actor)
+        self.enemies_version += 1
+      if actor in self.interactable:
+        del self.interactable[actor]
+        _remove_joined(self.interactable_list, actor)
+        self.interactable_version += 1
+
+  def interactable_enemies(self):
+    return self.interactable_list
+
+  def snapshot(self):
+    return (tuple(self.by_id), tuple(self.players), tuple(self.enemies),
+            tuple(self.interactable), tuple(self.pending_dead))
+
+  def restore(self, state):
+    """Return to a state recorded by `snapshot`.
+
+    Actors registered since are dropped. Versions are bumped rather than
+    restored, so caches keyed on them never see an old version again.
+    """
+    by_id, players, enemies, interactable, pending_dead = state
+    self.by_id = list(by_id)
+    self.players = dict.fromkeys(players)
+    self.enemies = dict.fromkeys(enemies)
+    self.interactable = dict.fromkeys(interactable)
+    self.pending_dead = list(pending_dead)
+    self.player_list = list(players)
+    self.enemy_list = list(enemies)
+    self.interactable_list = list(interactable)
+    self.players_version += 1
+    self.enemies_version += 1
+    self.interactable_version += 1
+
+
+# What `Battle.restore` needs to return a battle to an earlier point. Only
+# immutable records and references to actors, auras and items are kept.
+BattleSnapshot = collections.namedtuple('BattleSnapshot',
+                                        ['actors', 'registry', 'initiative'])
+
+
 class Battle():
-  def __init__(self, players, enemies):
-    self.players = players
-    self.enemies = enemies
+  """A fight between `players` and `enemies`.
+
+  The battle and its actors use `context` (a `BattleContext`) for
+  randomness, events and decisions, or the global context if it is None.
+  """
+  def __init__(self, players, enemies, context=None):
+    self.context = global_context if context is None else context
+    self.registry = ActorRegistry(self.context)
+    for player in players:
+      self.registry.add_player(player)
+    for enemy in enemies:
+      self.registry.add_enemy(enemy)
+    self.initiative = InitiativeQueue()
+
+  @property
+  def players(self):
+    return self.registry.player_list
+
+  @property
+  def enemies(self):
+    return self.registry.enemy_list
 
   def explain(self):
+    sink = self.context.sink
+    if not sink.enabled:
+      return
     player_infos = [(player.name, player.hp, player.mana, player.equipped,
                      player.auras)
                     for player in self.players]
     enemy_infos = [(enemy.name, enemy.hp, enemy.auras) for enemy in self.enemies]
 
-    print('players: ', player_infos)
-    print('enemies: ', enemy_infos)
+    sink.emit(events.Explain(player_infos, enemy_infos))
 
   def remove_dead_actors(self):
-    self.players = [player for player in self.players if player.alive]
-    self.enemies = [enemy for enemy in self.enemies if enemy.alive]
-    self.initiative_order = [
-        actor for actor in self.initiative_order if actor.alive
-    ]
+    profiler = self.context.profiler
+    if profiler is None:
+      self.registry.remove_dead_actors()
+      return
+    start = profiler.clock()
+    self.registry.remove_dead_actors()
+    profiler.record(profiling.DEATH_CLEANUP, type(self), start)
 
   def spawn_enemy(self, enemy, move_this_round=False):
-    self.enemies.append(enemy)
+    self.registry.add_enemy(enemy)
     if move_this_round:
-      self.sort_initiative_order(self.initiative_order + [enemy])
+      self.initiative.push(enemy)
 
   def sort_initiative_order(self, actors):
-    self.initiative_order = sorted(actors,
-                                   key=lambda actor: (-actor.stats[SPEED],
-                                                      actor.name))
+    profiler = self.context.profiler
+    if profiler is None:
+      self.initiative = InitiativeQueue(actors)
+      return
+    start = profiler.clock()
+    self.initiative = InitiativeQueue(actors)
+    profiler.record(profiling.INITIATIVE, type(self), start)
+
+  @property
+  def initiative_order(self):
+    return self.initiative.actors()
+
+  def snapshot(self):
+    """Record the battle's state, cheaply enough to do per action."""
+    registry = self.registry
+    return BattleSnapshot(tuple(actor.snapshot() for actor in registry.by_id),
+                          registry.snapshot(), self.initiative.snapshot())
+
+  def restore(self, snapshot):
+    """Return to `snapshot`. A snapshot can be restored any number of times."""
+    registry = self.registry
+    registry.restore(snapshot.registry)
+    for actor, state in zip(registry.by_id, snapshot.actors):
+      actor.restore(state)
+    self.initiative.restore(snapshot.initiative)
+
+  def state_key(self):
+    """Hashable key equal for battles in the same state.
+
+    Actors are described by content rather than identity, so the same state
+    reached along different paths gets the same key. Stats are left out, as
+    they do not change during a battle.
+    """
+    positions = {actor: position
+                 for position, actor in enumerate(self.players + self.enemies)}
+    return (tuple(player.state_key() for player in self.players),
+            tuple(enemy.state_key() for enemy in self.enemies),
+            tuple(positions[actor] for actor in self.initiative.actors()
+                  if actor in positions))
+
+  def state_hash(self):
+    """64-bit hash of `state_key`, stable across processes and runs."""
+    import hashlib
+    digest = hashlib.blake2b(repr(self.state_key()).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), 'little')
 
   def run_round(self):
     self.sort_initiative_order(self.players + self.enemies)
-    while self.initiative_order:
-      print('========================================')
-      current_actor = self.initiative_order.pop(0)
-      print("%s's turn" % current_actor)
+    self.continue_round()
+
+  def continue_round(self):
+    """Give turns to the actors still in the initiative queue."""
+    context = self.context
+    while True:
+      profiler = context.profiler
+      if profiler is not None:
+        start = profiler.clock()
+      current_actor = self.initiative.pop()
+      if profiler is not None:
+        profiler.record(profiling.TURN_SELECTION, type(self), start)
+      if current_actor is None:
+        break
+      sink = context.sink
+      if sink.enabled:
+        sink.emit(events.TurnStart(current_actor))
+      if profiler is not None:
+        start = profiler.clock()
       current_actor.take_turn(self)
+      if profiler is not None:
+        profiler.record(profiling.TURN, type(current_actor), start)
       self.remove_dead_actors()
       if not self.players or not self.enemies:
         break
@@ -418,10 +1218,10 @@ class Battle():
     while self.players and self.enemies:
       self.run_round()
     if not self.players:
-      print('All players dead. You lose.')
+      self.context.say('All players dead. You lose.')
       return False
     elif not self.enemies:
-      print('All enemies dead. You win.')
+      self.context.say('All enemies dead. You win.')
       return True
 
 
@@ -431,16 +1231,70 @@ def compute_damage(power, strength, resistance, damage_bonus, armor,
   return max(0, raw_damage) * damage_mult * received_damage_mult
 
 
+# Damages between aura-free actors, keyed on their compiled coefficients and
+# shared by all battles. See `Actor.resolve_attack`.
+attack_table = {}
+fixed_damage_table = {}
+
+
+def clear_damage_tables():
+  attack_table.clear()
+  fixed_damage_table.clear()
+
+
+def remember(cache, key, value, max_size=MAX_DAMAGE_TABLE):
+  """`cache[key] = value`, first emptying `cache` if it is full."""
+  if len(cache) >= max_size:
+    cache.clear()
+  cache[key] = value
+
+
+def resolve_damage(attack, defend, tagged):
+  """`compute_damage` from one damage type of an offense and a defense.
+
+  The user's power only counts if the weapon deals that damage type.
+  """
+  base_damage, power, strength, damage_bonus, damage_mult = attack
+  resistance, armor, received_damage_mult = defend
+  if tagged:
+    base_damage += power
+  return compute_damage(base_damage, strength, resistance, damage_bonus, armor,
+                        damage_mult, received_damage_mult)
+
+
+def set_decision_policy(policy):
+  """Install `policy` to answer `choose_option` and return the previous one."""
+  global decision_policy
+  previous = decision_policy
+  decision_policy = policy
+  return previous
+
+
+def move_choices(move):
+  """The options to pick, in order, for `Player.take_action` to make `move`."""
+  if move.action in (ATTACK, INTERACT):
+    return [move.action, move.target]
+  elif move.action == ABILITY:
+    return [move.action, move.ability]
+  elif move.action == ITEM:
+    return [move.action, move.item, move.target]
+  return [move.action]
+
+
 def choose_option(options, back=False):
+  """`choose` through the global context, for use outside battles."""
+  return global_context.choose(options, back)
+
+
+def prompt_choice(options):
+  """Ask on the console for one of `options` and return its index."""
   print('choices: ')
-  if back:
-    options = options + [BACK]
   for num_and_option in enumerate(options):
     print('  %d: %s' % num_and_option)
   choice = None
   while choice is None:
     try:
-      choice = options[int(input())]
+      choice = range(len(options))[int(input())]
     except ValueError:
       print('invalid input.')
     except IndexError:
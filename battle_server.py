@@ -0,0 +1,207 @@
+"""Asyncio server hosting many interactive boss crawls in one process.
+
+Each client connecting over TCP or a Unix socket plays its own crawl, like
+`boss_crawl.main`, answering each prompt with the number of an option.
+
+The engine asks for decisions synchronously from deep inside
+`Player.take_turn`, so each session plays its crawl in a thread of its own,
+in its own `battle_engine.BattleContext`. The session is that context's
+decision policy: asked for a choice, it has the event loop prompt the client
+and blocks until an answer comes off the session's queue of client lines.
+Every turn runs once, and sessions share no RNGs, sinks or policies with
+each other or with anything else running in the process.
+"""
+import argparse
+import asyncio
+import contextlib
+import threading
+
+import boss_crawl
+import events
+import simulate
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+class Disconnected(Exception):
+  """The client closed its connection."""
+
+
+async def run_in_thread(function, *args):
+  """Await `function(*args)`, run in a new daemon thread.
+
+  Sessions spend most of their time blocked on their clients, so each gets a
+  thread of its own rather than a slot in a bounded executor.
+  """
+  loop = asyncio.get_running_loop()
+  future = loop.create_future()
+  def settle(method, value):
+    # The future is cancelled if the server shuts down first.
+    if not future.done():
+      method(value)
+  def run():
+    try:
+      result = function(*args)
+    except BaseException as error:
+      outcome = (future.set_exception, error)
+    else:
+      outcome = (future.set_result, result)
+    with contextlib.suppress(RuntimeError):  # The loop has closed.
+      loop.call_soon_threadsafe(settle, *outcome)
+  threading.Thread(target=run, daemon=True).start()
+  return await future
+
+
+class SessionSink(events.Sink):
+  """Collects rendered events for a client."""
+  def __init__(self):
+    self.lines = []
+
+  def emit(self, event):
+    text = events.render(event)
+    if text is not None:
+      self.lines.append(text)
+
+  def take(self):
+    lines = self.lines
+    self.lines = []
+    return lines
+
+
+class BattleSession(simulate.Policy):
+  """One client's crawl, and the decision policy answering for it.
+
+  The crawl is seeded like battle `index` of a `simulate` run with `seed`,
+  so a session is reproducible from its seed, index and answers. The crawl's
+  thread only touches the sink while the event loop waits for it, and the
+  event loop only while the crawl waits for an answer.
+  """
+  def __init__(self, reader, writer, seed=0, index=0, difficulty=None):
+    self.reader = reader
+    self.writer = writer
+    self.difficulty = difficulty
+    self.sink = SessionSink()
+    self.context = simulate.battle_context(seed, index)
+    self.context.sink = self.sink
+    self.context.decisions = self
+    # Lines sent by the client, then None once it disconnects.
+    self.answers = asyncio.Queue()
+    self.loop = None
+
+  def choose(self, options):
+    """Called from the crawl's thread; block until the client answers."""
+    index = asyncio.run_coroutine_threadsafe(self.ask(options),
+                                             self.loop).result()
+    return options[index]
+
+  def say(self, text):
+    self.sink.lines.append(text)
+
+  async def flush(self):
+    lines = self.sink.take()
+    if lines:
+      self.writer.write(('\n'.join(lines) + '\n').encode())
+    await self.writer.drain()
+
+  async def read_answers(self):
+    """Queue the lines the client sends until it disconnects."""
+    try:
+      while True:
+        line = await self.reader.readline()
+        if not line:
+          break
+        self.answers.put_nowait(line)
+    except ConnectionError:
+      pass
+    self.answers.put_nowait(None)
+
+  async def ask(self, options):
+    """Prompt the client until it picks one of `options`; return the index."""
+    self.say('choices: ')
+    for num_and_option in enumerate(options):
+      self.say('  %d: %s' % num_and_option)
+    while True:
+      await self.flush()
+      line = await self.answers.get()
+      if line is None:
+        raise Disconnected()
+      try:
+        return range(len(options))[int(line.decode())]
+      except (ValueError, IndexError):
+        self.say('invalid input.')
+
+  async def play(self):
+    """Play a crawl like `boss_crawl.main`; return the final score."""
+    self.loop = asyncio.get_running_loop()
+    reading = asyncio.create_task(self.read_answers())
+    try:
+      score = await run_in_thread(boss_crawl.main, self.context,
+                                  self.difficulty)
+    finally:
+      reading.cancel()
+    await self.flush()
+    return score
+
+
+class BattleServer():
+  """Plays a `BattleSession` with each client that connects.
+
+  Sessions are numbered in the order clients connect, and seeded from
+  `seed` and their number.
+  """
+  def __init__(self, seed=0, difficulty=None):
+    self.seed = seed
+    self.difficulty = difficulty
+    self.sessions = set()
+    self.started = 0
+
+  async def handle(self, reader, writer):
+    session = BattleSession(reader, writer, self.seed, self.started,
+                            self.difficulty)
+    self.started += 1
+    self.sessions.add(session)
+    try:
+      await session.play()
+    except (Disconnected, ConnectionError):
+      pass
+    finally:
+      self.sessions.discard(session)
+      writer.close()
+      with contextlib.suppress(ConnectionError):
+        await writer.wait_closed()
+
+  async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+    """Start listening on `host`:`port`, or on the Unix socket `path`."""
+    if path is None:
+      return await asyncio.start_server(self.handle, host, port)
+    return await asyncio.start_unix_server(self.handle, path)
+
+  async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+    server = await self.start(host, port, path)
+    async with server:
+      print('Listening on %s' % ', '.join(
+          str(sock.getsockname()) for sock in server.sockets))
+      await server.serve_forever()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--host', default=DEFAULT_HOST)
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+  parser.add_argument('--unix', metavar='PATH',
+                      help='Listen on this Unix socket instead of TCP.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--difficulty', choices=['easy', 'hard'],
+                      default=boss_crawl.DIFFICULTY)
+  args = parser.parse_args()
+
+  server = BattleServer(args.seed, args.difficulty)
+  try:
+    asyncio.run(server.serve(args.host, args.port, args.unix))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
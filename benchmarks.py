@@ -0,0 +1,391 @@
+"""Benchmarks of the engine's hot paths.
+
+Each benchmark is seeded, timed with `timeit` (best of several repeats) and
+reported as seconds and calls per second. Results are saved as JSON, and a
+previous results file can be passed with --compare to print speedups.
+
+Import times of the engine modules are measured too, each in a fresh
+interpreter. The budgets in `IMPORT_BUDGETS` are relative to a stdlib import
+timed in the same run, so they hold on slow and fast machines alike;
+--check-imports fails if a module is over budget or pulls in a heavy
+optional dependency.
+
+--check-strength plays a fixed matchup with the greedy and MCTS policies
+and fails if MCTS wins less often than greedy, or falls short of the exact
+solver's optimum by more than `STRENGTH_TOLERANCE`, beyond noise.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+
+import battle_engine
+import boss_crawl
+import build_search
+import create_character
+import events
+import exact_solver
+import grid
+import mcts
+import simulate
+
+import abilities
+import enemies
+
+DEFAULT_REPEAT = 5
+BUILD_POINTS = 5
+# Enough hp that nobody dies during a benchmark.
+UNKILLABLE_HP = 10**9
+# Time allowed to import each module (bytecode already compiled) in a fresh
+# interpreter, as a multiple of the time `IMPORT_BASELINE` takes.
+IMPORT_BASELINE = 'argparse'
+IMPORT_BUDGETS = {
+  'battle_engine': 2,
+  'abilities': 2,
+  'grid': 2.5,
+  'create_character': 3,
+  'boss_crawl': 3,
+  'simulate': 4,
+}
+# Modules that importing the engine must not load; they are imported where
+# they are used.
+HEAVY_MODULES = ('numpy', 'networkx', 'matplotlib')
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(' '.join(name for name in %r if name in sys.modules))
+'''
+# Matchup played by --check-strength.
+STRENGTH_BUILD = ['Max HP +2', 'Physical Power +1', 'Physical Strength *2']
+STRENGTH_ENCOUNTER = 'papa roach=1'
+STRENGTH_BATTLES = 100
+# How far below the exact solver's win probability MCTS may fall, on top of
+# twice the standard error of its win rate.
+STRENGTH_TOLERANCE = 0.05
+
+
+def make_player(cells=()):
+  return create_character.create_character('Anzacel', list(cells), [])
+
+
+def make_aura(index):
+  return battle_engine.Aura(
+      'Aura %d' % index,
+      {(battle_engine.PHYSICAL, battle_engine.POWER): 1,
+       (battle_engine.PHYSICAL, battle_engine.STRENGTH): 1.01}, duration=3)
+
+
+def bench_compute_damage():
+  compute_damage = battle_engine.compute_damage
+  return lambda: compute_damage(2, 1.1, 1.5, 0.5, 0, 1, 1.25)
+
+
+def bench_get_attack_damage():
+  player = make_player()
+  target = enemies.PapaRoach()
+  tags = player.get_attack_tags()
+  return lambda: player.get_attack_damage(target, battle_engine.PHYSICAL,
+                                          tags)
+
+
+def bench_resolve_new_target(num_targets=1000):
+  """The first attack on an enemy, as after a spawn or in a new battle."""
+  player = make_player()
+  targets = itertools.cycle([enemies.LilBug() for _ in range(num_targets)])
+  tags = player.get_attack_tags()
+  # More targets than an actor remembers, so every attack resolves afresh.
+  assert num_targets > battle_engine.MAX_DAMAGE_PAIRS
+  return lambda: player.resolve_attack(next(targets), tags)
+
+
+def bench_get_aura_effect(num_auras):
+  player = make_player()
+  for index in range(num_auras):
+    player.add_aura(make_aura(index))
+  key = (battle_engine.PHYSICAL, battle_engine.STRENGTH)
+  return lambda: player.get_aura_effect(key, battle_engine.MULT)
+
+
+def bench_run_round(enemy_class, num_enemies, rounds=1):
+  """Play `rounds` rounds from the same start on every call."""
+  player = make_player()
+  player.hp = UNKILLABLE_HP
+  battle = battle_engine.Battle([player], [])
+  for _ in range(num_enemies):
+    enemy = enemy_class()
+    enemy.hp = UNKILLABLE_HP
+    battle.spawn_enemy(enemy)
+  snapshot = battle.snapshot()
+  def run():
+    battle.restore(snapshot)
+    for _ in range(rounds):
+      battle.run_round()
+  return run
+
+
+def bench_legal_moves(num_enemies):
+  """Legal move queries between actions, as search policies make them."""
+  player = make_player()
+  battle = battle_engine.Battle(
+      [player], [enemies.LilBug() for _ in range(num_enemies)])
+  player.action_points = battle_engine.MAX_ACTION_POINTS
+  return lambda: player.get_legal_moves(battle)
+
+
+def bench_create_character():
+  compiled = grid.compiled_grid
+  builds = [compiled.cells_of(build)
+            for build in build_search.reachable_builds(compiled, BUILD_POINTS)]
+  def run():
+    for cells in builds:
+      create_character.create_character('Anzacel', cells, [])
+  return run
+
+
+def bench_derive_builds():
+  compiled = grid.compiled_grid
+  selected = create_character.get_build_deriver(compiled).selection_matrix(
+      list(build_search.reachable_builds(compiled, BUILD_POINTS)))
+  return lambda: create_character.derive_builds(selected, compiled)
+
+
+def bench_pray_construct():
+  return abilities.Pray
+
+
+def bench_pray_use():
+  policy = simulate.GreedyDamagePolicy()
+  context = battle_engine.BattleContext(
+      rng=random.Random(random.getrandbits(32)), decisions=policy)
+  player = make_player()
+  battle = battle_engine.Battle([player], [enemies.PapaRoach()], context)
+  pray = abilities.Pray()
+  policy.start_turn(player, battle)
+  snapshot = battle.snapshot()
+  def run():
+    battle.restore(snapshot)
+    pray.use(player, battle)
+  return run
+
+
+def bench_battle():
+  cells = grid.compiled_grid.cells[:BUILD_POINTS]
+  encounter = simulate.parse_encounter('papa roach=1')
+  policy = simulate.GreedyDamagePolicy()
+  return lambda: simulate.simulate_battle(cells, encounter, policy)
+
+
+# (name, setup, setup arguments, calls per repeat). Setups return the
+# function to time; build counts are per reachable build of BUILD_POINTS.
+BENCHMARKS = [
+  ('compute_damage', bench_compute_damage, (), 100000),
+  ('get_attack_damage', bench_get_attack_damage, (), 20000),
+  ('resolve_attack_new_target', bench_resolve_new_target, (), 20000),
+  ('get_aura_effect_0_auras', bench_get_aura_effect, (0,), 100000),
+  ('get_aura_effect_5_auras', bench_get_aura_effect, (5,), 100000),
+  ('get_aura_effect_50_auras', bench_get_aura_effect, (50,), 100000),
+  ('run_round_1_lil_bug', bench_run_round, (enemies.LilBug, 1), 2000),
+  ('run_round_4_lil_bugs', bench_run_round, (enemies.LilBug, 4), 1000),
+  ('run_round_16_lil_bugs', bench_run_round, (enemies.LilBug, 16), 300),
+  ('run_round_64_lil_bugs', bench_run_round, (enemies.LilBug, 64), 100),
+  ('spawn_storm_4_papa_roaches_5_rounds', bench_run_round,
+   (enemies.PapaRoach, 4, 5), 100),
+  ('spawn_storm_16_papa_roaches_5_rounds', bench_run_round,
+   (enemies.PapaRoach, 16, 5), 20),
+  ('legal_moves_4_lil_bugs', bench_legal_moves, (4,), 100000),
+  ('create_character_all_builds', bench_create_character, (), 20),
+  ('derive_builds_all_builds', bench_derive_builds, (), 20),
+  ('pray_construct', bench_pray_construct, (), 2000),
+  ('pray_use', bench_pray_use, (), 2000),
+  ('headless_battle', bench_battle, (), 200),
+]
+
+
+def run_benchmark(setup, args, number, repeat=DEFAULT_REPEAT, seed=0):
+  """Return the best time per call of the function `setup(*args)` returns."""
+  random.seed(seed)
+  np.random.seed(seed)
+  function = setup(*args)
+  return min(timeit.Timer(function).repeat(repeat, number)) / number
+
+
+def import_time(module, repeat=DEFAULT_REPEAT):
+  """Return (best seconds to import `module`, heavy modules it loaded).
+
+  Each import runs in a fresh interpreter from this directory.
+  """
+  directory = os.path.dirname(os.path.abspath(__file__))
+  times = []
+  for _ in range(repeat):
+    output = subprocess.run(
+        [sys.executable, '-c', _IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+        cwd=directory, capture_output=True, text=True, check=True).stdout
+    seconds, heavy = output.split('\n')[:2]
+    times.append(float(seconds))
+  return min(times), heavy.split()
+
+
+def import_times(repeat=DEFAULT_REPEAT):
+  """{module: {'seconds', 'relative', 'budget', 'heavy'}} per budgeted module.
+
+  `relative` is `seconds` over the time `IMPORT_BASELINE` took.
+  """
+  subprocess.run([sys.executable, '-m', 'compileall', '-q',
+                  os.path.dirname(os.path.abspath(__file__))], check=True)
+  baseline, _ = import_time(IMPORT_BASELINE, repeat)
+  results = {}
+  for module, budget in IMPORT_BUDGETS.items():
+    seconds, heavy = import_time(module, repeat)
+    results[module] = {'seconds': seconds, 'relative': seconds / baseline,
+                       'budget': budget, 'heavy': heavy}
+  return results
+
+
+def over_budget(imports):
+  """Names of modules in `import_times` results that broke their budget."""
+  return [module for module, result in imports.items()
+          if result['relative'] > result['budget'] or result['heavy']]
+
+
+def policy_strength(num_battles=STRENGTH_BATTLES, seed=0):
+  """Win rates of the greedy and MCTS policies on the strength matchup.
+
+  Both play the same seeded battles. 'exact' is the optimum the exact solver
+  finds, never using abilities it cannot model.
+  """
+  cells = simulate.find_cells(STRENGTH_BUILD)
+  encounter = simulate.parse_encounter(STRENGTH_ENCOUNTER)
+  player = create_character.create_character('Anzacel', cells, [])
+  solution = exact_solver.solve(boss_crawl.create_battle(player, encounter),
+                                skip_unsupported=True)
+  results = {'exact': solution.win_probability}
+  for name, policy in [('greedy', simulate.GreedyDamagePolicy()),
+                       ('mcts', mcts.MCTSPolicy())]:
+    results[name] = simulate.run_battles(cells, encounter, policy,
+                                         num_battles, seed=seed).win_rate()
+  return results
+
+
+def too_weak(strength, num_battles=STRENGTH_BATTLES):
+  """Whether MCTS fell short in `policy_strength` results, beyond noise."""
+  win_rate = strength['mcts']
+  noise = 2 * math.sqrt(win_rate * (1 - win_rate) / num_battles)
+  return (win_rate + noise < strength['greedy'] or
+          win_rate + noise + STRENGTH_TOLERANCE < strength['exact'])
+
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run_benchmarks(names=None, repeat=DEFAULT_REPEAT, seed=0, scale=1,
+                   imports=True):
+  """Run the benchmarks whose names contain one of `names`, or all of them.
+
+  `scale` multiplies the number of calls timed per repeat. Import times are
+  measured too unless `imports` is false.
+  """
+  policy = simulate.GreedyDamagePolicy()
+  previous_policy = battle_engine.set_decision_policy(policy)
+  previous_sink = events.set_sink(events.NullSink())
+  results = {}
+  try:
+    for name, setup, args, number in BENCHMARKS:
+      if names and not any(part in name for part in names):
+        continue
+      number = max(1, int(number * scale))
+      seconds = run_benchmark(setup, args, number, repeat, seed)
+      results[name] = {'seconds': seconds, 'per_second': 1 / seconds,
+                       'number': number, 'repeat': repeat}
+  finally:
+    battle_engine.set_decision_policy(previous_policy)
+    events.set_sink(previous_sink)
+  return {
+    'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'seed': seed,
+    'results': results,
+    'imports': import_times(repeat) if imports else {},
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('names', nargs='*',
+                      help='Only run benchmarks whose names contain these.')
+  parser.add_argument('--output', default='benchmarks.json')
+  parser.add_argument('--compare', help='Earlier results file to compare to.')
+  parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--scale', type=float, default=1,
+                      help='Multiplies the number of calls timed.')
+  parser.add_argument('--check-imports', action='store_true',
+                      help='Only measure import times; fail if over budget.')
+  parser.add_argument('--check-strength', action='store_true',
+                      help='Only compare MCTS with greedy play and the '
+                      'exact optimum; fail if MCTS is weaker.')
+  parser.add_argument('--battles', type=int, default=STRENGTH_BATTLES,
+                      help='Battles per policy for --check-strength.')
+  args = parser.parse_args()
+
+  if args.check_strength:
+    strength = policy_strength(args.battles, args.seed)
+    for name, win_rate in strength.items():
+      print('%-8s %6.3f' % (name, win_rate))
+    if too_weak(strength, args.battles):
+      print('MCTS is weaker than expected')
+      raise SystemExit(1)
+    return
+
+  if args.check_imports:
+    imports = import_times(args.repeat)
+    for module, result in imports.items():
+      print('%-20s %8.1f ms %6.2fx %s  (budget %.2fx) %s' % (
+          module, result['seconds'] * 1e3, result['relative'],
+          IMPORT_BASELINE, result['budget'], ' '.join(result['heavy'])))
+    failed = over_budget(imports)
+    if failed:
+      print('Over budget: %s' % ', '.join(failed))
+      raise SystemExit(1)
+    return
+
+  report = run_benchmarks(args.names, args.repeat, args.seed, args.scale)
+  baseline = {}
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)['results']
+  for name, result in report['results'].items():
+    line = '%-40s %12.3f us %14.1f/s' % (name, result['seconds'] * 1e6,
+                                          result['per_second'])
+    if name in baseline:
+      line += '  %5.2fx' % (baseline[name]['seconds'] / result['seconds'])
+    print(line)
+  for module, result in report['imports'].items():
+    print('import %-33s %12.3f ms' % (module, result['seconds'] * 1e3))
+  with open(args.output, 'w') as output_file:
+    json.dump(report, output_file, indent=2)
+  print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+  main()
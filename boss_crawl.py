@@ -18,45 +18,52 @@ BOSSES = {
 }
 
 
-def create_battle(anzacel, encounter):
+def create_battle(anzacel, encounter, context=None):
   battle_enemies = []
   if not encounter:
-    return battle_engine.Battle([anzacel], [enemies.LilBug()])
+    return battle_engine.Battle([anzacel], [enemies.LilBug()], context)
   for boss, number in encounter.items():
     for _ in range(number):
       battle_enemies.append(BOSSES[boss]())
-  return battle_engine.Battle([anzacel], battle_enemies)
+  return battle_engine.Battle([anzacel], battle_enemies, context)
 
 
-def main():
-  cells = choose_grid.choose_grid()
+def next_battle(anzacel, encounter, score, difficulty=None, context=None):
+  """Escalate `encounter` after `score` wins and create the next battle."""
+  difficulty = difficulty or DIFFICULTY
+  if difficulty == 'hard':
+    if score % 3 == 2:
+      encounter['papa roach'] -= 1
+      encounter['horn dog'] += 1
+    else:
+      encounter['papa roach'] += 1  
+    return create_battle(anzacel, encounter, context)
+
+  elif difficulty == 'easy':
+    enemy = enemies.PapaRoach() if score % 2 == 1 else enemies.HornDog()
+    return battle_engine.Battle([anzacel], [enemy], context)
+
+  else:
+    raise ValueError('Invalid difficulty %s' % difficulty)
+
+
+def main(context=None, difficulty=None):
+  """Play a crawl in `context` (the global one by default); return the score."""
+  if context is None:
+    context = battle_engine.global_context
+  cells = choose_grid.choose_grid(context=context)
   anzacel = create_character.create_character('Anzacel', cells, [])
 
   encounter = collections.Counter()
   score = 0
-  battle = create_battle(anzacel, encounter)
+  battle = create_battle(anzacel, encounter, context)
   while battle.start():
     score += 1
-    print('Your current score: %d' % score)
-    print()
-
-    if DIFFICULTY == 'hard':
-      if score % 3 == 2:
-        encounter['papa roach'] -= 1
-        encounter['horn dog'] += 1
-      else:
-        encounter['papa roach'] += 1  
-      battle = create_battle(anzacel, encounter)
-
-    elif DIFFICULTY == 'easy':
-      enemy = enemies.PapaRoach() if score % 2 == 1 else enemies.HornDog()
-      battle = battle_engine.Battle([anzacel], [enemy])
-
-    else:
-      raise ValueError('Invalid difficulty %s' % DIFFICULTY)
-
+    context.say('Your current score: %d\n' % score)
+    battle = next_battle(anzacel, encounter, score, difficulty, context)
 
-  print('Game over. Your score: %d' % score)
+  context.say('Game over. Your score: %d' % score)
+  return score
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""Search the skill grid for the builds that simulate best.
+
+A build is a set of grid nodes in which every node's parent is either the
+root or also in the set, which is what `choose_grid.choose_grid` can reach.
+Selections that differ only in the order cells were picked are the same
+build, so builds are handled as `grid.CompiledGrid` selection bitmasks.
+"""
+import argparse
+
+import grid
+import simulate
+
+DEFAULT_BATTLES = 200
+DEFAULT_BEAM_WIDTH = 8
+
+
+def reachable_builds(compiled, num_points):
+  """Yield each build of `num_points` cells exactly once.
+
+  If the grid has fewer cells than that, yield the whole grid, as
+  `choose_grid` would.
+  """
+  num_points = min(num_points, len(compiled))
+
+  def extend(build, size, frontier):
+    if size == num_points:
+      yield build
+      return
+    if not frontier:
+      return
+    # Either take the lowest frontier node or rule it out for good; every
+    # build is produced along exactly one such path.
+    bit = frontier & -frontier
+    node = bit.bit_length() - 1
+    yield from extend(build | bit, size + 1,
+                      (frontier ^ bit) | compiled.child_masks[node])
+    yield from extend(build, size, frontier ^ bit)
+
+  yield from extend(0, 0, compiled.root_mask)
+
+
+class WinRateEvaluator():
+  """Scores a build by its simulated win rate, caching per build.
+
+  Every build is played with the same seed so that scores are compared on
+  common random numbers.
+  """
+  def __init__(self, compiled, encounter, policy, num_battles=DEFAULT_BATTLES,
+               seed=0, inventory=()):
+    self.compiled = compiled
+    self.encounter = encounter
+    self.policy = policy
+    self.num_battles = num_battles
+    self.seed = seed
+    self.inventory = inventory
+    self.cache = {}
+
+  def __call__(self, build):
+    if build not in self.cache:
+      tally = simulate.run_battles(self.compiled.cells_of(build),
+                                   self.encounter,
+                                   self.policy, self.num_battles,
+                                   self.inventory, seed=self.seed)
+      self.cache[build] = tally.win_rate()
+    return self.cache[build]
+
+
+def exhaustive_search(compiled, evaluate, num_points, top=1):
+  """Evaluate every reachable build; return the best (score, build) pairs."""
+  scored = [(evaluate(build), build)
+            for build in reachable_builds(compiled, num_points)]
+  return sorted(scored, key=_rank)[:top]
+
+
+def beam_search(compiled, evaluate, num_points, beam_width=DEFAULT_BEAM_WIDTH,
+                top=1):
+  """Grow builds one cell at a time, keeping the `beam_width` best.
+
+  Partial builds are scored with `evaluate` too, so this is a heuristic.
+  """
+  num_points = min(num_points, len(compiled))
+  beam = [(evaluate(0), 0)]
+  for _ in range(num_points):
+    candidates = {build | 1 << node
+                  for _, build in beam
+                  for node in grid.nodes_of(compiled.frontier(build))}
+    if not candidates:
+      break
+    beam = sorted(((evaluate(build), build) for build in candidates),
+                  key=_rank)[:beam_width]
+  return beam[:top]
+
+
+def _rank(scored):
+  # Best score first; ties broken by the cells chosen, for stable output.
+  score, build = scored
+  return -score, build
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--points', type=int, default=5)
+  parser.add_argument('--encounter', default='papa roach=1',
+                      help="Comma-separated 'boss=count' pairs.")
+  parser.add_argument('--policy', choices=sorted(simulate.POLICIES),
+                      default='greedy')
+  parser.add_argument('--battles', type=int, default=DEFAULT_BATTLES)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--beam', type=int, default=0,
+                      help='Beam width; 0 searches exhaustively.')
+  parser.add_argument('--top', type=int, default=5)
+  args = parser.parse_args()
+
+  compiled = grid.compiled_grid
+  evaluate = WinRateEvaluator(compiled,
+                              simulate.parse_encounter(args.encounter),
+                              simulate.POLICIES[args.policy](), args.battles,
+                              args.seed)
+  if args.beam:
+    best = beam_search(compiled, evaluate, args.points, args.beam, args.top)
+  else:
+    best = exhaustive_search(compiled, evaluate, args.points, args.top)
+  for score, build in best:
+    print('%.3f  %s' % (score, compiled.cells_of(build)))
+  print('%d builds evaluated' % len(evaluate.cache))
+
+
+if __name__ == '__main__':
+  main()
@@ -4,13 +4,20 @@ import grid
 DEFAULT_NUM_POINTS = 5
 
 
-def choose_grid(num_points=DEFAULT_NUM_POINTS):
+def choose_grid(num_points=DEFAULT_NUM_POINTS, compiled=None, context=None):
+  """Have `context`'s decision policy (the global one by default) pick cells."""
+  if compiled is None:
+    compiled = grid.compiled_grid
+  if context is None:
+    context = battle_engine.global_context
   cells = []
-  options = grid.grid.children
+  # Node IDs, in the order their cells are offered.
+  options = list(grid.nodes_of(compiled.root_mask))
   while num_points and options:
-    cell = battle_engine.choose_option(options)
-    cells.append(cell.grid_cell)
-    options.remove(cell)
-    options.extend(cell.children)
+    cell = context.choose([compiled.cells[node] for node in options])
+    node = next(node for node in options if compiled.cells[node] is cell)
+    cells.append(cell)
+    options.remove(node)
+    options.extend(compiled.children[node])
     num_points -= 1
-  return cells
\ No newline at end of file
+  return cells
@@ -1,4 +1,7 @@
+import functools
+
 import battle_engine
+import grid
 import grid_cells
 
 import abilities
@@ -55,3 +58,78 @@ def create_pray_ability(cells):
       special_spells.extend(cell.spells)
 
   return abilities.Pray(specials=special_spells, num_choices=num_pray_options)
+
+
+class BuildDeriver():
+  """Vectorized `update_stats` and `create_pray_ability` over many builds.
+
+  Holds each grid cell's additive and multiplicative effects as arrays of
+  shape (cells, stats), with stats indexed by `battle_engine.STAT_INDEX`.
+  """
+  def __init__(self, compiled):
+    import numpy as np
+    self.compiled = compiled
+    self.base = np.array(battle_engine.StatBlock(DEFAULT_STATS).values)
+    self.adds = np.array(compiled.stat_adds, dtype=float).reshape(
+        len(compiled), battle_engine.NUM_STATS)
+    self.mults = np.array(compiled.stat_mults, dtype=float).reshape(
+        len(compiled), battle_engine.NUM_STATS)
+    self.mult_nodes = np.flatnonzero((self.mults != 1).any(axis=1))
+    self.pray_options = np.array(compiled.pray_options, dtype=int)
+    self.spell_nodes = np.array([node for node in range(len(compiled))
+                                 if compiled.spells[node]], dtype=int)
+
+  def selection_matrix(self, selections):
+    """Turn `grid.CompiledGrid` bitmasks into a (builds, cells) bool matrix."""
+    import numpy as np
+    nodes = range(len(self.compiled))
+    return np.array([[selection >> node & 1 for node in nodes]
+                     for selection in selections], dtype=bool).reshape(
+                         len(selections), len(nodes))
+
+  def derive(self, selected):
+    """Return (stats, pray option counts, special spell tuples) per build.
+
+    `selected` is a (builds, cells) 0/1 matrix. Stats come back as a (builds,
+    stats) array equal to `update_stats(DEFAULT_STATS.copy(), cells)`.
+    Additions are applied before multiplications, which is only the same as
+    picking the cells in any order if no stat is both added to and
+    multiplied; such builds raise ValueError.
+    """
+    import numpy as np
+    selected = np.asarray(selected, dtype=bool)
+    weights = selected.astype(float)
+    added = weights @ (self.adds != 0)
+    multiplied = weights @ (self.mults != 1)
+    conflicts = (added > 0) & (multiplied > 0)
+    if conflicts.any():
+      build, stat = np.argwhere(conflicts)[0]
+      raise ValueError('Build %d both adds to and multiplies %r' %
+                       (build, battle_engine.STAT_KEYS[stat]))
+
+    stats = self.base + weights @ self.adds
+    for node in self.mult_nodes:
+      stats *= np.where(selected[:, node, None], self.mults[node], 1)
+
+    pray_options = DEFAULT_PRAY_OPTIONS + selected @ self.pray_options
+    # Builds that share their spell cells share one spell tuple.
+    bits = 1 << np.arange(len(self.spell_nodes))
+    keys = selected[:, self.spell_nodes] @ bits
+    spells_by_key = {}
+    for key in np.unique(keys):
+      spells_by_key[key] = tuple(
+          spell
+          for bit, node in enumerate(self.spell_nodes) if key >> bit & 1
+          for spell in self.compiled.spells[node])
+    spells = [spells_by_key[key] for key in keys]
+    return stats, pray_options, spells
+
+
+@functools.lru_cache(maxsize=None)
+def get_build_deriver(compiled=None):
+  return BuildDeriver(grid.compiled_grid if compiled is None else compiled)
+
+
+def derive_builds(selected, compiled=None):
+  """`BuildDeriver.derive` for the default (or given) compiled grid."""
+  return get_build_deriver(compiled).derive(selected)
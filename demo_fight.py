@@ -6,7 +6,7 @@ import items
 import weapons
 
 
-def main():
+def main(context=None):
   sword = weapons.Sword('Sword', 2)
   magic_wand = weapons.MagicWand('Magic wand', 2)
   anzacel = battle_engine.Player(
@@ -27,7 +27,8 @@ def main():
       abilities=[abilities.Pray(0.5, 1.25, 0.5, 0.75, 3)])
 
   battle = battle_engine.Battle([anzacel],
-                                [enemies.PapaRoach(), enemies.HornDog()])
+                                [enemies.PapaRoach(), enemies.HornDog()],
+                                context)
   battle.start()
 
 
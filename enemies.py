@@ -1,9 +1,10 @@
-import random
-
 import battle_engine
+import events
 
 
 class PapaRoach(battle_engine.Enemy):
+  __slots__ = ()
+
   def __init__(self):
     battle_engine.Enemy.__init__(
         self,
@@ -24,15 +25,17 @@ class PapaRoach(battle_engine.Enemy):
   def take_turn(self, battle):
     available_actions = ['spawn', 'attack']
     if self.hp >= 2:
-      action = random.choice(available_actions)
+      action = self.context.rng.choice(available_actions)
     else:
       action = 'attack'
     if action == 'attack':
-      target = random.choice(battle.players)
+      target = self.context.rng.choice(battle.players)
       self.attack_target(target, self.get_standard_attack_tags())
     elif action == 'spawn':
       lilbug = LilBug()
-      print('%s spawned %s' % (self.name, lilbug))
+      sink = self.context.sink
+      if sink.enabled:
+        sink.emit(events.Spawn(self, lilbug))
       battle.spawn_enemy(lilbug)
       self.hp //= 2
     self.decrement_auras()
@@ -48,6 +51,8 @@ class PapaRoach(battle_engine.Enemy):
 
 
 class LilBug(battle_engine.Enemy):
+  __slots__ = ()
+
   def __init__(self):
     battle_engine.Enemy.__init__(
         self,
@@ -75,8 +80,10 @@ class LilBug(battle_engine.Enemy):
     return True
 
   def react(self, interactor):
-    print("%s bit %s's finger. %s took 1 damage." %
-          (self.name, interactor.name, interactor.name))
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Message("%s bit %s's finger. %s took 1 damage." %
+                               (self.name, interactor.name, interactor.name)))
     interactor.take_damage(1)
 
   def get_standard_attack_tags(self):
@@ -84,6 +91,8 @@ class LilBug(battle_engine.Enemy):
 
 
 class HornDog(battle_engine.Enemy):
+  __slots__ = ('thorns_damage',)
+
   def __init__(self):
     battle_engine.Enemy.__init__(
         self,
@@ -113,14 +122,9 @@ class HornDog(battle_engine.Enemy):
     return [battle_engine.PHYSICAL]
 
   def respond_to_attack(self, attacker):
-    thorns_damage = round(battle_engine.compute_damage(
-        power=0,
-        strength=0,
-        resistance=1,
-        damage_bonus=self.thorns_damage,
-        armor=attacker.get_armor(battle_engine.PHYSICAL),
-        damage_mult=1,
-        received_damage_mult=attacker.get_received_damage_multiplier(
-            battle_engine.PHYSICAL)))
-    print('%s dealt %d thorns damage' % (self.name, thorns_damage))
+    thorns_damage = round(attacker.get_fixed_damage(
+        self.thorns_damage, battle_engine.PHYSICAL))
+    sink = self.context.sink
+    if sink.enabled:
+      sink.emit(events.Thorns(self, attacker, thorns_damage))
     attacker.take_damage(thorns_damage)
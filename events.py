@@ -0,0 +1,135 @@
+"""Typed battle events and the sinks that consume them.
+
+The engine emits events instead of printing. Emitters check `sink.enabled`
+before building an event, so installing a `NullSink` skips all formatting.
+"""
+import collections
+import sys
+
+
+Attack = collections.namedtuple('Attack',
+                                ['attacker', 'target', 'damage', 'crit'])
+Damage = collections.namedtuple('Damage', ['target', 'amount', 'hp'])
+Heal = collections.namedtuple('Heal', ['target', 'amount', 'hp'])
+ManaSpent = collections.namedtuple('ManaSpent', ['actor', 'amount', 'mana'])
+AuraApplied = collections.namedtuple('AuraApplied', ['target', 'aura'])
+AuraExpired = collections.namedtuple('AuraExpired', ['actor', 'aura'])
+Spawn = collections.namedtuple('Spawn', ['spawner', 'spawned'])
+# `verb` is how the death is described, e.g. 'destroyed' or 'defeated'.
+Death = collections.namedtuple('Death', ['actor', 'verb'])
+Thorns = collections.namedtuple('Thorns', ['source', 'target', 'damage'])
+TurnStart = collections.namedtuple('TurnStart', ['actor'])
+Explain = collections.namedtuple('Explain', ['players', 'enemies'])
+AbilityUsed = collections.namedtuple('AbilityUsed', ['actor', 'ability'])
+ItemUsed = collections.namedtuple('ItemUsed', ['actor', 'item', 'target'])
+Message = collections.namedtuple('Message', ['text'])
+
+
+def _render_attack(event):
+  lines = ['%s attacked %s.' % (event.attacker.name, event.target.name)]
+  if event.crit:
+    lines.append('Critical hit!')
+  lines.append('%s took %d damage.' % (event.target.name, event.damage))
+  return '\n'.join(lines)
+
+
+_RENDERERS = {
+  Attack: _render_attack,
+  Damage: lambda event: '%s has %d hp remaining.' % (event.target.name,
+                                                      event.hp),
+  Heal: lambda event: '%s has %d hp remaining.' % (event.target.name,
+                                                    event.hp),
+  ManaSpent: lambda event: '%s has %d mana remaining.' % (event.actor.name,
+                                                          event.mana),
+  AuraApplied: lambda event: None,
+  AuraExpired: lambda event: '%s wore off of %s' % (event.aura.name,
+                                                     event.actor.name),
+  Spawn: lambda event: '%s spawned %s' % (event.spawner.name, event.spawned),
+  Death: lambda event: '%s was %s' % (event.actor.name, event.verb),
+  Thorns: lambda event: '%s dealt %d thorns damage' % (event.source.name,
+                                                        event.damage),
+  TurnStart: lambda event: ('========================================\n'
+                            "%s's turn" % event.actor),
+  Explain: lambda event: ('players:  %s\nenemies:  %s' %
+                          (event.players, event.enemies)),
+  Message: lambda event: event.text,
+  AbilityUsed: lambda event: None,
+  ItemUsed: lambda event: None,
+}
+
+
+def render(event):
+  """Return the console text for `event`, or None if it has none."""
+  return _RENDERERS[type(event)](event)
+
+
+class Sink():
+  enabled = True
+
+  def begin_battle(self, index):
+    """Called by batch runners before battle `index` of a run."""
+
+  def emit(self, event):
+    raise NotImplementedError
+
+
+class NullSink(Sink):
+  """Discards events; emitters skip building them altogether."""
+  enabled = False
+
+  def emit(self, event):
+    pass
+
+
+class ConsoleSink(Sink):
+  """Renders events as text on `stream`, stdout by default."""
+  def __init__(self, stream=None):
+    self.stream = stream
+
+  def emit(self, event):
+    text = render(event)
+    if text is not None:
+      print(text, file=self.stream or sys.stdout)
+
+
+class CollectorSink(Sink):
+  """Buffers events in memory."""
+  def __init__(self):
+    self.events = []
+
+  def emit(self, event):
+    self.events.append(event)
+
+  def clear(self):
+    self.events = []
+
+
+class FileSink(Sink):
+  """Appends rendered events to the file at `path`."""
+  def __init__(self, path):
+    self.file = open(path, 'a')
+
+  def emit(self, event):
+    text = render(event)
+    if text is not None:
+      self.file.write(text + '\n')
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+sink = ConsoleSink()
+
+
+def set_sink(new_sink):
+  """Install `new_sink` for all battle events and return the previous one."""
+  global sink
+  previous = sink
+  sink = new_sink
+  return previous
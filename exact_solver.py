@@ -0,0 +1,458 @@
+"""Exact win probabilities for small encounters.
+
+Models a one-player `battle_engine.Battle` as a Markov decision process over
+compact state tuples and solves it by dynamic programming. The only
+randomness is the crit roll and PapaRoach's spawn-or-attack choice, so small
+encounters have few enough states to enumerate. Transitions are computed by
+rebuilding throwaway actors from a state and running the engine's own
+damage, item and ability code on them, so the model stays faithful to the
+engine.
+
+Supported: attacks, items whose use needs no further choices (Potion,
+BerserkerPotion, weapons; re-equipping the equipped weapon is left out as a
+wasted action point), Heal and AreaFlames, against enemies that use
+`Enemy.take_turn` or `PapaRoach.take_turn` and start without auras.
+Interacting and looking never help and are left out.
+"""
+import argparse
+import collections
+import copy
+
+import battle_engine
+import events
+import simulate
+
+import abilities
+import enemies
+
+
+# Player moves.
+ATTACK = 'attack'
+ITEM = 'item'
+ABILITY = 'ability'
+END_TURN = 'end turn'
+
+# Item targets are the player or an enemy's position in `State.enemies`.
+PLAYER_TARGET = -1
+
+SUPPORTED_ABILITIES = (abilities.Heal, abilities.AreaFlames)
+
+# `enemies` is a tuple of (enemy kind, hp, still to move this round), in the
+# order of `Battle.enemies`. `auras` is a tuple of (aura kind, duration) and
+# `inventory` a sorted tuple of item kinds. A positive `action_points` means
+# the player is in the middle of a turn.
+State = collections.namedtuple(
+    'State', ['hp', 'mana', 'action_points', 'player_pending', 'auras',
+              'inventory', 'equipped', 'enemies'])
+
+
+class Kinds():
+  """Interns prototypes under a key, so states can refer to them by index."""
+  def __init__(self, key):
+    self.key = key
+    self.ids = {}
+    self.prototypes = []
+
+  def intern(self, prototype):
+    key = self.key(prototype)
+    if key not in self.ids:
+      self.ids[key] = len(self.prototypes)
+      self.prototypes.append(prototype)
+    return self.ids[key]
+
+  def __getitem__(self, kind):
+    return self.prototypes[kind]
+
+
+def _enemy_key(enemy):
+  return (type(enemy), tuple(enemy.stats.values),
+          getattr(enemy, 'thorns_damage', None))
+
+
+def _item_key(item):
+  return (type(item), repr(item), getattr(item, 'base_power', None))
+
+
+def _aura_key(aura):
+  return (aura.name, aura.effects)
+
+
+class Model():
+  """Encodes battles as `State`s and enumerates their transitions."""
+  def __init__(self, battle, skip_unsupported=False):
+    if len(battle.players) != 1:
+      raise ValueError('Only one-player battles can be solved')
+    self.player = battle.players[0]
+    self.enemy_kinds = Kinds(_enemy_key)
+    self.item_kinds = Kinds(_item_key)
+    self.aura_kinds = Kinds(_aura_key)
+    self.abilities = []
+    for index, ability in enumerate(self.player.abilities):
+      if type(ability) in SUPPORTED_ABILITIES:
+        self.abilities.append(index)
+      elif not skip_unsupported:
+        raise ValueError('Unsupported ability %r' % ability)
+    for enemy in battle.enemies:
+      if enemy.auras:
+        raise ValueError('%s starts with auras' % enemy.name)
+    self.check_enemy(enemies.LilBug())
+
+  def check_enemy(self, enemy):
+    if type(enemy).take_turn not in (battle_engine.Enemy.take_turn,
+                                     enemies.PapaRoach.take_turn):
+      raise ValueError('Unsupported turn logic of %s' % enemy.name)
+    return self.enemy_kinds.intern(enemy)
+
+  def encode(self, battle, player, player_pending, enemies_pending):
+    """Return the `State` of `player` and the enemies of `battle`.
+
+    `enemies_pending` is the set of enemies still to move this round.
+    """
+    return State(
+        hp=player.hp,
+        mana=player.mana,
+        action_points=player.action_points,
+        player_pending=player_pending,
+        auras=tuple((self.aura_kinds.intern(aura), aura.duration)
+                    for aura in player.auras),
+        inventory=tuple(sorted(self.item_kinds.intern(item)
+                               for item in player.inventory)),
+        equipped=(None if player.equipped is None
+                  else self.item_kinds.intern(player.equipped)),
+        enemies=tuple((self.check_enemy(enemy), enemy.hp,
+                       enemy in enemies_pending)
+                      for enemy in battle.enemies))
+
+  def initial_state(self, battle):
+    """The state of `battle` at the start of its next round."""
+    state = self.encode(battle, self.player, True, set(battle.enemies))
+    return state._replace(action_points=0)
+
+  def decode(self, state):
+    """Build a throwaway battle in `state`.
+
+    Returns the battle, its player and the set of enemies still to move.
+    """
+    player = copy.copy(self.player)
+    player.hp = state.hp
+    player.alive = state.hp > 0
+    player.mana = state.mana
+    player.action_points = state.action_points
+    player.auras = [
+        battle_engine.Aura(self.aura_kinds[kind].name,
+                           self.aura_kinds[kind].effects_dict, duration)
+        for kind, duration in state.auras]
+    player.rebuild_aura_effects()
+    player.inventory = [copy.copy(self.item_kinds[kind])
+                        for kind in state.inventory]
+    player.equipped = (None if state.equipped is None
+                       else copy.copy(self.item_kinds[state.equipped]))
+    battle_enemies = []
+    pending = set()
+    for kind, hp, enemy_pending in state.enemies:
+      enemy = copy.copy(self.enemy_kinds[kind])
+      enemy.hp = hp
+      enemy.alive = True
+      enemy.auras = []
+      enemy.rebuild_aura_effects()
+      battle_enemies.append(enemy)
+      if enemy_pending:
+        pending.add(enemy)
+    return battle_engine.Battle([player], battle_enemies), player, pending
+
+  def value(self, state):
+    """1 or 0 if the battle is over in `state`, else None."""
+    if state.hp <= 0:
+      return 0.0
+    if not state.enemies:
+      return 1.0
+    return None
+
+  def moves(self, state):
+    """Legal player moves in a mid-turn `state`."""
+    action_points = state.action_points
+    moves = []
+    if action_points >= battle_engine.ACTION_COST[battle_engine.ATTACK]:
+      moves.extend((ATTACK, position)
+                   for position in range(len(state.enemies)))
+    if action_points >= battle_engine.ACTION_COST[battle_engine.ITEM]:
+      battle, player, _ = self.decode(state)
+      for kind in sorted(set(state.inventory)):
+        if kind == state.equipped:
+          # Weapons stay in the inventory, and equipping the one in hand only
+          # burns an action point.
+          continue
+        item = self.item_kinds[kind]
+        for target in item.get_valid_targets(player, battle):
+          position = (PLAYER_TARGET if target is player
+                      else battle.enemies.index(target))
+          moves.append((ITEM, kind, position))
+    for index in self.abilities:
+      ability = self.player.abilities[index]
+      if (ability.ap_cost <= action_points and
+          ability.mana_cost <= state.mana):
+        moves.append((ABILITY, index))
+    moves.append((END_TURN,))
+    return moves
+
+  def next_actor(self, state):
+    """None for the player, else the position of the next enemy to move."""
+    candidates = []
+    if state.player_pending:
+      candidates.append((-self.player.stats.values[battle_engine.SPEED_INDEX],
+                         self.player.name, 0, None))
+    for position, (kind, _, pending) in enumerate(state.enemies):
+      if pending:
+        enemy = self.enemy_kinds[kind]
+        candidates.append((-enemy.stats.values[battle_engine.SPEED_INDEX],
+                           enemy.name, position + 1, position))
+    return min(candidates)[-1] if candidates else False
+
+  def chance_outcomes(self, state):
+    """Outcomes of the next non-player step as [(probability, state)]."""
+    actor = self.next_actor(state)
+    if actor is False:
+      # New round: everyone still standing moves again.
+      return [(1.0, state._replace(
+          player_pending=True,
+          enemies=tuple((kind, hp, True) for kind, hp, _ in state.enemies)))]
+    if actor is None:
+      return [(1.0, state._replace(
+          player_pending=False,
+          action_points=battle_engine.MAX_ACTION_POINTS))]
+    return self.enemy_turn(state, actor)
+
+  def enemy_turn(self, state, position):
+    kind, hp, _ = state.enemies[position]
+    outcomes = []
+    if (type(self.enemy_kinds[kind]).take_turn is enemies.PapaRoach.take_turn
+        and hp >= 2):
+      battle, player, pending = self.decode(state)
+      papa_roach = battle.enemies[position]
+      pending.discard(papa_roach)
+      battle.spawn_enemy(enemies.LilBug())
+      papa_roach.hp //= 2
+      papa_roach.decrement_auras()
+      outcomes.append((0.5, self.finish(battle, player, state.player_pending,
+                                        pending)))
+      attack_probability = 0.5
+    else:
+      attack_probability = 1.0
+    for probability, crit in _crit_outcomes():
+      battle, player, pending = self.decode(state)
+      attacker = battle.enemies[position]
+      pending.discard(attacker)
+      _attack(attacker, player, attacker.get_standard_attack_tags(), crit)
+      attacker.decrement_auras()
+      outcomes.append((attack_probability * probability,
+                       self.finish(battle, player, state.player_pending,
+                                   pending)))
+    return _merge(outcomes)
+
+  def player_outcomes(self, state, move):
+    """Outcomes of the player making `move` as [(probability, state)]."""
+    if move[0] == ATTACK:
+      outcomes = []
+      for probability, crit in _crit_outcomes():
+        battle, player, pending = self.decode(state)
+        _attack(player, battle.enemies[move[1]], player.get_attack_tags(),
+                crit)
+        player.action_points -= battle_engine.ACTION_COST[battle_engine.ATTACK]
+        outcomes.append((probability,
+                         self.end_action(battle, player, pending)))
+      return _merge(outcomes)
+
+    battle, player, pending = self.decode(state)
+    if move[0] == ITEM:
+      _, kind, position = move
+      item = next(item for item in player.inventory
+                  if self.item_kinds.intern(item) == kind)
+      target = player if position == PLAYER_TARGET else battle.enemies[position]
+      item.use(player, target)
+      player.action_points -= battle_engine.ACTION_COST[battle_engine.ITEM]
+    elif move[0] == ABILITY:
+      ability = player.abilities[move[1]]
+      ability.use(player, battle)
+      player.spend_mana(ability.mana_cost)
+      player.action_points -= ability.ap_cost
+    else:
+      player.action_points = 0
+    return [(1.0, self.end_action(battle, player, pending))]
+
+  def end_action(self, battle, player, pending):
+    """Mirror the bottom of the `Player.take_turn` loop."""
+    battle.remove_dead_actors()
+    if player.action_points <= 0 or not player.alive or not battle.enemies:
+      player.decrement_auras()
+      player.action_points = 0
+    return self.encode(battle, player, False, pending)
+
+  def finish(self, battle, player, player_pending, pending):
+    battle.remove_dead_actors()
+    return self.encode(battle, player, player_pending, pending)
+
+
+def _crit_outcomes():
+  return [(1 - battle_engine.CRIT_PROBABILITY, False),
+          (battle_engine.CRIT_PROBABILITY, True)]
+
+
+def _attack(attacker, target, attack_tags, crit):
+  """`Actor.attack_target` with the crit roll fixed."""
+  damage = sum(attacker.get_attack_damages(target, attack_tags))
+  if crit:
+    damage *= battle_engine.CRIT_MULTIPLIER
+  target.take_damage(round(damage))
+  target.respond_to_attack(attacker)
+
+
+def _merge(outcomes):
+  merged = collections.OrderedDict()
+  for probability, state in outcomes:
+    merged[state] = merged.get(state, 0) + probability
+  return [(probability, state) for state, probability in merged.items()]
+
+
+class Solution():
+  """Optimal values and moves for every state reachable in a battle."""
+  def __init__(self, model, initial_state, values, best_moves):
+    self.model = model
+    self.initial_state = initial_state
+    self.values = values
+    self.best_moves = best_moves
+
+  @property
+  def win_probability(self):
+    return self.values[self.initial_state]
+
+  def __len__(self):
+    return len(self.values)
+
+
+def solve(battle, skip_unsupported=False, tolerance=1e-12,
+          max_states=1000000):
+  """Solve `battle` from the start of its next round.
+
+  Returns a `Solution` whose `win_probability` is the chance of winning under
+  optimal play. With `skip_unsupported`, abilities the model does not cover
+  are never used instead of raising ValueError.
+  """
+  previous_sink = events.set_sink(events.NullSink())
+  try:
+    model = Model(battle, skip_unsupported)
+    initial = model.initial_state(battle)
+    # state -> None (terminal), ('chance', outcomes) or
+    # ('decision', [(move, outcomes)]).
+    graph = {}
+    order = []
+    stack = [(initial, False)]
+    while stack:
+      state, expanded = stack.pop()
+      if expanded:
+        order.append(state)
+        continue
+      if state in graph:
+        continue
+      if len(graph) >= max_states:
+        raise ValueError('More than %d states' % max_states)
+      if model.value(state) is not None:
+        graph[state] = None
+        order.append(state)
+        continue
+      if state.action_points > 0:
+        node = ('decision', [(move, model.player_outcomes(state, move))
+                             for move in model.moves(state)])
+        successors = [next_state for _, outcomes in node[1]
+                      for _, next_state in outcomes]
+      else:
+        node = ('chance', model.chance_outcomes(state))
+        successors = [next_state for _, next_state in node[1]]
+      graph[state] = node
+      stack.append((state, True))
+      stack.extend((next_state, False) for next_state in successors
+                   if next_state not in graph)
+  finally:
+    events.set_sink(previous_sink)
+
+  # Sweeping in DFS post-order visits successors first, so an acyclic graph
+  # is solved exactly in one sweep; cycles need more.
+  values = {state: model.value(state) or 0.0 for state in graph}
+  best_moves = {}
+  change = 1
+  while change > tolerance:
+    change = 0
+    for state in order:
+      node = graph[state]
+      if node is None:
+        continue
+      kind, branches = node
+      if kind == 'chance':
+        value = sum(probability * values[next_state]
+                    for probability, next_state in branches)
+      else:
+        value = -1
+        for move, outcomes in branches:
+          move_value = sum(probability * values[next_state]
+                           for probability, next_state in outcomes)
+          if move_value > value:
+            value = move_value
+            best_moves[state] = move
+      change = max(change, abs(value - values[state]))
+      values[state] = value
+  return Solution(model, initial, values, best_moves)
+
+
+class OptimalPolicy(simulate.Policy):
+  """Plays the moves of a `Solution` through `choose_option`."""
+  def __init__(self, solution):
+    self.solution = solution
+    self.plan = []
+
+  def reset(self):
+    self.plan = []
+
+  def choose(self, options):
+    if battle_engine.END_TURN not in options:
+      return self.plan.pop(0)
+    battle, player = self.battle, self.actor
+    pending = set(actor for actor in battle.initiative.actors()
+                  if actor is not player)
+    state = self.solution.model.encode(battle, player, False, pending)
+    move = self.solution.best_moves[state]
+    if move[0] == ATTACK:
+      self.plan = [battle.enemies[move[1]]]
+      return battle_engine.ATTACK
+    if move[0] == ITEM:
+      _, kind, position = move
+      item = next(item for item in player.inventory
+                  if self.solution.model.item_kinds.intern(item) == kind)
+      target = player if position == PLAYER_TARGET else battle.enemies[position]
+      self.plan = [item, target]
+      return battle_engine.ITEM
+    if move[0] == ABILITY:
+      self.plan = [player.abilities[move[1]]]
+      return battle_engine.ABILITY
+    return battle_engine.END_TURN
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--build', default='',
+                      help='Comma-separated grid cell names.')
+  parser.add_argument('--encounter', default='papa roach=1',
+                      help="Comma-separated 'boss=count' pairs.")
+  args = parser.parse_args()
+
+  import boss_crawl
+  import create_character
+  cells = simulate.find_cells([name for name in args.build.split(',') if name])
+  player = create_character.create_character('Anzacel', cells, [])
+  battle = boss_crawl.create_battle(player,
+                                    simulate.parse_encounter(args.encounter))
+  solution = solve(battle, skip_unsupported=True)
+  print('%d states, win probability %.6f' % (len(solution),
+                                              solution.win_probability))
+
+
+if __name__ == '__main__':
+  main()
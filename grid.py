@@ -1,9 +1,4 @@
-try:
-  import networkx as nx
-  import matplotlib.pyplot as plt
-except ImportError:
-  nx = None
-  plt = None
+import functools
 
 import battle_engine
 import grid_cells
@@ -20,7 +15,95 @@ class Node():
     return repr(self.grid_cell)
 
 
+class CompiledGrid():
+  """Immutable, index-based form of the tree under a root `Node`.
+
+  Nodes below the root are numbered breadth-first. A selection of nodes is
+  an int bitmask with bit i set when node i is selected, so selections are
+  canonical, hashable and cheap to extend.
+  """
+  __slots__ = ('cells', 'parents', 'children', 'child_masks', 'root_mask',
+               'stat_adds', 'stat_mults', 'pray_options', 'spells')
+
+  def __init__(self, root):
+    cells = []
+    parents = []
+    queue = [(child, -1) for child in root.children]
+    while queue:
+      node, parent = queue.pop(0)
+      queue.extend((child, len(cells)) for child in node.children)
+      cells.append(node.grid_cell)
+      parents.append(parent)
+    self.cells = tuple(cells)
+    # -1 for children of the root.
+    self.parents = tuple(parents)
+    self.children = tuple(
+        tuple(child for child, parent in enumerate(parents) if parent == node)
+        for node in range(len(cells)))
+    self.child_masks = tuple(sum(1 << child for child in children)
+                             for children in self.children)
+    self.root_mask = sum(1 << node for node, parent in enumerate(parents)
+                         if parent == -1)
+
+    # Per-node effects on stat vectors indexed by battle_engine.STAT_INDEX.
+    stat_adds = []
+    stat_mults = []
+    for cell in cells:
+      adds = [0] * battle_engine.NUM_STATS
+      mults = [1] * battle_engine.NUM_STATS
+      if isinstance(cell, grid_cells.AddStats):
+        for stat, amount in cell.stats_dict.items():
+          adds[battle_engine.stat_index(stat)] += amount
+      elif isinstance(cell, grid_cells.MultiplyStats):
+        for stat, amount in cell.stats_dict.items():
+          mults[battle_engine.stat_index(stat)] *= amount
+      stat_adds.append(tuple(adds))
+      stat_mults.append(tuple(mults))
+    self.stat_adds = tuple(stat_adds)
+    self.stat_mults = tuple(stat_mults)
+    self.pray_options = tuple(
+        cell.amount
+        if isinstance(cell, grid_cells.IncreaseNumberOfPrayOptions) else 0
+        for cell in cells)
+    self.spells = tuple(
+        tuple(cell.spells) if isinstance(cell, grid_cells.AddPraySpells)
+        else () for cell in cells)
+
+  def __len__(self):
+    return len(self.cells)
+
+  def frontier(self, selection):
+    """Bitmask of the nodes that could be selected next."""
+    reachable = self.root_mask
+    for node in nodes_of(selection):
+      reachable |= self.child_masks[node]
+    return reachable & ~selection
+
+  def select(self, selection, frontier, node):
+    """Add `node` to `selection`; return the new (selection, frontier)."""
+    bit = 1 << node
+    return selection | bit, (frontier & ~bit) | self.child_masks[node]
+
+  def is_reachable(self, selection):
+    """Whether every selected node's parent is the root or selected."""
+    return all(self.parents[node] == -1 or selection >> self.parents[node] & 1
+               for node in nodes_of(selection))
+
+  def cells_of(self, selection):
+    """Grid cells of `selection`, parents before children."""
+    return [self.cells[node] for node in nodes_of(selection)]
+
+
+def nodes_of(selection):
+  """Node IDs set in a selection bitmask, in increasing order."""
+  while selection:
+    low_bit = selection & -selection
+    yield low_bit.bit_length() - 1
+    selection ^= low_bit
+
+
 def convert_nx_graph(root):
+  import networkx as nx
   graph = nx.Graph()
   graph.add_node(root.grid_cell)
   parent = root
@@ -35,6 +118,8 @@ def convert_nx_graph(root):
 
 
 def show_nx_graph(graph):
+  import matplotlib.pyplot as plt
+  import networkx as nx
   nx.draw(graph, with_labels=True, font_weight='bold')
   plt.show()
 
@@ -77,10 +162,32 @@ def construct_grid():
   return root
 
 
-grid = construct_grid()
+@functools.lru_cache(maxsize=None)
+def get_grid():
+  return construct_grid()
+
+
+@functools.lru_cache(maxsize=None)
+def get_compiled_grid():
+  return CompiledGrid(get_grid())
+
+
+_LAZY_ATTRIBUTES = {
+  'grid': get_grid,
+  'compiled_grid': get_compiled_grid,
+}
+
+
+def __getattr__(name):
+  # `grid` and `compiled_grid` are built on first use, not at import.
+  if name in _LAZY_ATTRIBUTES:
+    return _LAZY_ATTRIBUTES[name]()
+  raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 if __name__ == '__main__':
-  if nx is not None and plt is not None:
-    graph = convert_nx_graph(grid)
+  try:
+    graph = convert_nx_graph(get_grid())
     show_nx_graph(graph)
+  except ImportError:
+    print('Showing the grid needs networkx and matplotlib.')
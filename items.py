@@ -1,7 +1,10 @@
 import battle_engine
+import events
 
 
 class Potion(battle_engine.Item):
+  __slots__ = ()
+
   def get_valid_targets(self, user, battle):
     return battle.players
 
@@ -14,6 +17,8 @@ class Potion(battle_engine.Item):
 
 
 class BerserkerPotion(Potion):
+  __slots__ = ()
+
   def use(self, user, target):
     berserker_aura = battle_engine.Aura(
     'Berserk',
@@ -22,7 +27,10 @@ class BerserkerPotion(Potion):
         (battle_engine.PHYSICAL, battle_engine.RECEIVED_DAMAGE_MULTIPLIER): 1.25,
         (battle_engine.SPECIAL, battle_engine.RECEIVED_DAMAGE_MULTIPLIER): 1.25,
     }, duration=3)
-    user.auras.append(berserker_aura)
+    user.add_aura(berserker_aura)
+    sink = user.context.sink
+    if sink.enabled:
+      sink.emit(events.AuraApplied(user, berserker_aura))
     user.inventory.remove(self)
 
   def __repr__(self):
@@ -0,0 +1,357 @@
+"""Monte Carlo tree search decision policy.
+
+The engine asks for decisions from deep inside `Player.take_turn`, so a
+search cannot simply resume the game from a decision point. Instead
+`MCTSPolicy` snapshots the battle and its context's RNGs when its turn starts.
+Each iteration restores that snapshot and replays the turn's earlier choices,
+which reproduces the current position exactly. It then reseeds the RNGs,
+descends the tree and finishes the battle with a rollout policy. The live
+battle and RNGs are restored once the search is over.
+
+Rollouts are greedy by default: uniformly random ones almost never win, which
+leaves the tree with nothing to go on. Nodes expand the rollout policy's
+choice first, and the tree only spans the next `tree_depth` decisions. Its
+values average all the play below an option, so in a deeper tree options
+followed by many menus are dragged down by the weak moves tried in them,
+while options followed by chance (like Pray's random offer) reach fresh nodes
+and escape it.
+
+The greedy policy also gives each live decision a prior: the search only
+overrules the greedy choice when another option's win rate is ahead by more
+than `separation` standard errors, as a few dozen rollouts per option cannot
+tell close options apart.
+
+Tree statistics live in a transposition table keyed by `Battle.state_key`,
+so work done for one decision is reused by later decisions that reach the
+same state.
+"""
+import argparse
+import math
+import time
+
+import battle_engine
+import events
+import simulate
+
+DEFAULT_ITERATIONS = 100
+DEFAULT_EXPLORATION = math.sqrt(2)
+# Rounds a rollout may run past the end of the current one.
+DEFAULT_ROLLOUT_ROUNDS = 30
+# The table is cleared when it grows past this many nodes.
+DEFAULT_MAX_NODES = 200000
+# Decisions per iteration made by the tree; the rollout policy makes the rest.
+DEFAULT_TREE_DEPTH = 2
+# Standard errors by which an option must beat the prior's choice to be
+# picked instead.
+DEFAULT_SEPARATION = 1.0
+
+
+def useful_options(options):
+  """Indices of options that can change the battle."""
+  return [index for index, option in enumerate(options)
+          if option is not battle_engine.BACK and option != battle_engine.LOOK]
+
+
+class Node():
+  """Visit counts and total rewards of one decision's options."""
+  __slots__ = ('options', 'visits', 'child_visits', 'child_rewards')
+
+  def __init__(self, options):
+    # Indices into the offered options, BACK and LOOK left out.
+    self.options = options
+    self.visits = 0
+    self.child_visits = [0] * len(options)
+    self.child_rewards = [0.0] * len(options)
+
+  def untried(self):
+    return [position for position, visits in enumerate(self.child_visits)
+            if not visits]
+
+  def select(self, exploration):
+    """Position of the option with the best UCB1 score."""
+    log_visits = math.log(self.visits)
+    def ucb(position):
+      visits = self.child_visits[position]
+      return (self.child_rewards[position] / visits +
+              exploration * math.sqrt(log_visits / visits))
+    return max(range(len(self.options)), key=ucb)
+
+  def most_visited(self):
+    return max(range(len(self.options)),
+               key=lambda position: self.child_visits[position])
+
+  def beats(self, position, other, separation):
+    """Whether option `position` won more often than option `other`, by more
+    than `separation` standard errors of the difference."""
+    visits = self.child_visits[position]
+    other_visits = self.child_visits[other]
+    if not visits or not other_visits:
+      return False
+    rewards = self.child_rewards[position]
+    other_rewards = self.child_rewards[other]
+    win_rate = (rewards + other_rewards) / (visits + other_visits)
+    error = math.sqrt(win_rate * (1 - win_rate) *
+                      (1 / visits + 1 / other_visits))
+    return (rewards / visits - other_rewards / other_visits >
+            separation * error)
+
+
+def decision_key(battle, context, options):
+  """Transposition table key of a decision.
+
+  `context` holds the choices made since the last top-level action menu, so
+  e.g. the target menus of two different items are told apart.
+  """
+  return (battle.state_key(), context, tuple(map(repr, options)))
+
+
+class MCTSPolicy(simulate.Policy):
+  """Chooses by Monte Carlo tree search over the headless engine.
+
+  Each decision gets `iterations` iterations, or as many as fit in
+  `time_limit` seconds if that is given. Rollout seeds are drawn from the
+  battle's RNG, whose state is then restored, so seeded games stay
+  reproducible. `prior_policy` (greedy by default) makes the choice the
+  search falls back on; it must not draw from the battle's RNGs.
+  """
+  def __init__(self, iterations=DEFAULT_ITERATIONS, time_limit=None,
+               exploration=DEFAULT_EXPLORATION, rollout_policy=None,
+               rollout_rounds=DEFAULT_ROLLOUT_ROUNDS,
+               max_nodes=DEFAULT_MAX_NODES, prior_policy=None,
+               separation=DEFAULT_SEPARATION, tree_depth=DEFAULT_TREE_DEPTH):
+    self.iterations = iterations
+    self.time_limit = time_limit
+    self.exploration = exploration
+    if rollout_policy is None:
+      rollout_policy = simulate.GreedyDamagePolicy()
+    self.rollout_policy = rollout_policy
+    if prior_policy is None:
+      prior_policy = simulate.GreedyDamagePolicy()
+    self.prior_policy = prior_policy
+    self.separation = separation
+    self.tree_depth = tree_depth
+    self.rollout_rounds = rollout_rounds
+    self.max_nodes = max_nodes
+    self.table = {}
+    self.simulations = 0
+    self.search_time = 0.0
+    self.searcher = _Searcher(self)
+    self.clear_turn()
+
+  def clear_turn(self):
+    self.turn_snapshot = None
+    self.turn_random_state = None
+    self.turn_np_random_state = None
+    # Indices of the choices made so far this turn.
+    self.prefix = []
+    self.context = ()
+
+  def reset(self):
+    self.table = {}
+    self.prior_policy.reset()
+    self.clear_turn()
+
+  def start_turn(self, actor, battle):
+    simulate.Policy.start_turn(self, actor, battle)
+    self.prior_policy.start_turn(actor, battle)
+    self.turn_snapshot = battle.snapshot()
+    self.turn_random_state = battle.context.rng.getstate()
+    self.turn_np_random_state = battle.context.np_rng.get_state()
+    self.prefix = []
+    self.context = ()
+
+  def choose(self, options):
+    if battle_engine.END_TURN in options:
+      self.context = ()
+    prior = self.prior_policy.choose(options)
+    prior_index = next(index for index, option in enumerate(options)
+                       if option is prior)
+    candidates = useful_options(options)
+    if len(candidates) == 1:
+      index = candidates[0]
+    else:
+      index = self.search(options, candidates, prior_index)
+    if index != prior_index:
+      # The prior's plans for the rest of the turn no longer apply.
+      self.prior_policy.reset()
+    self.prefix.append(index)
+    self.context += (repr(options[index]),)
+    return options[index]
+
+  def search(self, options, candidates, prior_index):
+    """Return the index of the best of `candidates` among `options`.
+
+    That is the prior's choice, `prior_index`, unless the search finds an
+    option clearly better.
+    """
+    if len(self.table) > self.max_nodes:
+      self.table = {}
+    battle = self.battle
+    key = decision_key(battle, self.context, options)
+    root = self.table.get(key)
+    if root is None:
+      root = self.table[key] = Node(candidates)
+
+    context = battle.context
+    live_snapshot = battle.snapshot()
+    random_state = context.rng.getstate()
+    np_random_state = context.np_rng.get_state()
+    base_seed = context.rng.getrandbits(32)
+    previous_policy = context.decisions
+    previous_sink = context.sink
+    context.decisions = self.searcher
+    context.sink = events.NullSink()
+    start = time.perf_counter()
+    try:
+      iteration = 0
+      while True:
+        if self.time_limit is None:
+          if iteration >= self.iterations:
+            break
+        elif time.perf_counter() - start >= self.time_limit:
+          break
+        self.simulate((base_seed + iteration) % 2**32)
+        iteration += 1
+    finally:
+      battle.restore(live_snapshot)
+      context.rng.setstate(random_state)
+      context.np_rng.set_state(np_random_state)
+      context.decisions = previous_policy
+      context.sink = previous_sink
+      self.search_time += time.perf_counter() - start
+    self.simulations += iteration
+    best = root.most_visited()
+    if prior_index in root.options:
+      prior = root.options.index(prior_index)
+      if best != prior and not root.beats(best, prior, self.separation):
+        best = prior
+    return root.options[best]
+
+  def simulate(self, seed):
+    """Run one iteration from the current decision and back up its result."""
+    battle, actor = self.battle, self.actor
+    battle.restore(self.turn_snapshot)
+    battle.context.rng.setstate(self.turn_random_state)
+    battle.context.np_rng.set_state(self.turn_np_random_state)
+    searcher = self.searcher
+    searcher.begin(self.prefix, seed)
+    self.rollout_policy.reset()
+
+    actor.take_turn(battle)
+    battle.remove_dead_actors()
+    if battle.players and battle.enemies:
+      battle.continue_round()
+    rounds = 0
+    while battle.players and battle.enemies and rounds < self.rollout_rounds:
+      battle.run_round()
+      rounds += 1
+    reward = float(bool(battle.players) and not battle.enemies)
+
+    for node, position in searcher.path:
+      node.visits += 1
+      node.child_visits[position] += 1
+      node.child_rewards[position] += reward
+
+  def simulations_per_second(self):
+    return self.simulations / self.search_time if self.search_time else 0
+
+  def __getstate__(self):
+    state = simulate.Policy.__getstate__(self)
+    # Snapshots and statistics refer to the battle in progress.
+    state.update(table={}, turn_snapshot=None, prefix=[], context=())
+    return state
+
+
+class _Searcher(simulate.Policy):
+  """Makes the decisions inside one `MCTSPolicy` iteration.
+
+  Replays the turn's earlier choices, then walks the tree, then rolls out.
+  """
+  def __init__(self, owner):
+    self.owner = owner
+    self.begin([], 0)
+
+  def start_turn(self, actor, battle):
+    simulate.Policy.start_turn(self, actor, battle)
+    self.owner.rollout_policy.start_turn(actor, battle)
+
+  def begin(self, prefix, seed):
+    self.prefix = prefix
+    self.position = 0
+    self.seed = seed
+    self.context = ()
+    self.rolling_out = False
+    # (node, option position) pairs to back up.
+    self.path = []
+
+  def choose(self, options):
+    if battle_engine.END_TURN in options:
+      self.context = ()
+    if self.position < len(self.prefix):
+      index = self.prefix[self.position]
+    else:
+      if self.position == len(self.prefix):
+        # Caught up with the live game; from here on, outcomes are sampled.
+        self.battle.context.rng.seed(self.seed)
+        self.battle.context.np_rng.seed(self.seed)
+      index = self.explore(options)
+    self.position += 1
+    self.context += (repr(options[index]),)
+    return options[index]
+
+  def explore(self, options):
+    owner = self.owner
+    if self.rolling_out:
+      choice = owner.rollout_policy.choose(options)
+      return next(index for index, option in enumerate(options)
+                  if option is choice)
+    candidates = useful_options(options) or list(range(len(options)))
+    key = decision_key(self.battle, self.context, options)
+    node = owner.table.get(key)
+    if node is None:
+      node = owner.table[key] = Node(candidates)
+    untried = node.untried()
+    if untried:
+      # Expand the rollout policy's choice first, so that a node's first
+      # visit plays the rollout policy's own line rather than a random move.
+      choice = owner.rollout_policy.choose(options)
+      index = next(index for index, option in enumerate(options)
+                   if option is choice)
+      if index in node.options and node.options.index(index) in untried:
+        position = node.options.index(index)
+      else:
+        position = self.battle.context.rng.choice(untried)
+        owner.rollout_policy.reset()
+      self.rolling_out = True
+    else:
+      position = node.select(owner.exploration)
+    self.path.append((node, position))
+    if len(self.path) >= owner.tree_depth:
+      self.rolling_out = True
+    return node.options[position]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--battles', type=int, default=20)
+  parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+  parser.add_argument('--time-limit', type=float, default=None,
+                      help='Seconds per decision; overrides --iterations.')
+  parser.add_argument('--tree-depth', type=int, default=DEFAULT_TREE_DEPTH)
+  parser.add_argument('--build', default='',
+                      help='Comma-separated grid cell names.')
+  parser.add_argument('--encounter', default='papa roach=1',
+                      help="Comma-separated 'boss=count' pairs.")
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  policy = MCTSPolicy(args.iterations, args.time_limit,
+                      tree_depth=args.tree_depth)
+  cells = simulate.find_cells([name for name in args.build.split(',') if name])
+  print(simulate.run_battles(cells, simulate.parse_encounter(args.encounter),
+                             policy, args.battles, seed=args.seed))
+  print('%.0f simulations per second' % policy.simulations_per_second())
+
+
+if __name__ == '__main__':
+  main()
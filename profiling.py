@@ -0,0 +1,72 @@
+"""Opt-in timing of the engine's phases.
+
+The engine checks `profiler` at each hook and does nothing else while it is
+None, so profiling costs next to nothing when disabled. An installed
+`Profiler` counts calls and sums wall time per phase and per class: the
+acting actor's class, or the ability or item class for resolution phases.
+Phases nest (e.g. damage computation happens inside a turn), so times are
+inclusive.
+"""
+import collections
+import time
+
+TURN_SELECTION = 'turn selection'
+TURN = 'turn'
+DAMAGE = 'damage computation'
+AURAS = 'aura aggregation'
+DEATH_CLEANUP = 'death cleanup'
+INITIATIVE = 'initiative sorting'
+ABILITY = 'ability resolution'
+ITEM = 'item resolution'
+
+
+class Profiler():
+  """Call counts and cumulative seconds keyed by (phase, class name)."""
+  def __init__(self, clock=time.perf_counter):
+    self.clock = clock
+    self.counts = collections.Counter()
+    self.seconds = collections.Counter()
+
+  def record(self, phase, cls, start):
+    """Count one `phase` call by `cls` that began at `clock()` == `start`."""
+    key = (phase, cls.__name__)
+    self.seconds[key] += self.clock() - start
+    self.counts[key] += 1
+
+  def merge(self, other):
+    self.counts.update(other.counts)
+    self.seconds.update(other.seconds)
+
+  def summary(self):
+    """{phase: {class name: {'calls': n, 'seconds': s}}}, JSON-ready."""
+    summary = {}
+    for (phase, name), calls in sorted(self.counts.items()):
+      summary.setdefault(phase, {})[name] = {
+          'calls': calls, 'seconds': self.seconds[phase, name]}
+    return summary
+
+  def report(self):
+    """Text table of phases and classes, slowest phase first."""
+    phase_seconds = collections.Counter()
+    for (phase, _), seconds in self.seconds.items():
+      phase_seconds[phase] += seconds
+    lines = ['%-20s %-20s %10s %10s %10s' % ('phase', 'class', 'calls',
+                                             'total ms', 'mean us')]
+    for phase, _ in phase_seconds.most_common():
+      for name, stats in sorted(self.summary()[phase].items(),
+                                key=lambda item: -item[1]['seconds']):
+        lines.append('%-20s %-20s %10d %10.1f %10.2f' % (
+            phase, name, stats['calls'], stats['seconds'] * 1e3,
+            stats['seconds'] / stats['calls'] * 1e6))
+    return '\n'.join(lines)
+
+
+profiler = None
+
+
+def set_profiler(new_profiler):
+  """Install `new_profiler` (None disables profiling); return the previous."""
+  global profiler
+  previous = profiler
+  profiler = new_profiler
+  return previous
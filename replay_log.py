@@ -0,0 +1,261 @@
+"""Compact binary battle logs for analysing many simulated battles.
+
+`BinaryLogSink` is an events sink that appends one fixed-width record per
+attack, damage, heal, aura change, spawn, death, thorns hit, turn start or
+ability/item use. Actor kinds (class names), aura, ability and item names
+are interned, and the interned strings are kept in a JSON sidecar next to the
+log. `ReplayLog` memory-maps a log as a NumPy structured array, so e.g.
+damage per enemy type is a couple of array operations away.
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+import events
+
+# Record kinds.
+ATTACK = 0
+DAMAGE = 1
+HEAL = 2
+AURA_APPLIED = 3
+AURA_EXPIRED = 4
+SPAWN = 5
+DEATH = 6
+THORNS = 7
+TURN_START = 8
+ABILITY_USED = 9
+ITEM_USED = 10
+KIND_NAMES = ['attack', 'damage', 'heal', 'aura applied', 'aura expired',
+              'spawn', 'death', 'thorns', 'turn start', 'ability used',
+              'item used']
+
+# `actor` and `target` are IDs within the battle's registry, -1 if unknown;
+# `actor_kind`, `target_kind` and `name` index the interned strings, -1 if
+# unused. `value` is the damage, heal or thorns amount and `hp` the hp after
+# a damage or heal. `name` is the aura, ability or item involved.
+RECORD_DTYPE = np.dtype([
+    ('battle', '<u4'), ('kind', 'u1'), ('crit', 'u1'),
+    ('actor', '<i4'), ('actor_kind', '<i4'),
+    ('target', '<i4'), ('target_kind', '<i4'),
+    ('name', '<i4'), ('value', '<f4'), ('hp', '<f4')])
+_RECORD = struct.Struct('<IBBiiiiiff')
+assert _RECORD.size == RECORD_DTYPE.itemsize
+
+# Records buffered in memory before being written out.
+DEFAULT_BUFFER_RECORDS = 4096
+
+
+def names_path(path):
+  return path + '.names.json'
+
+
+class BinaryLogSink(events.Sink):
+  """Appends battle events to the binary log at `path`.
+
+  Logs are append-only; reopening an existing log keeps its records and
+  interned names, unless `append` is false, which starts it afresh. Call
+  `begin_battle` between battles (batch runners do) to number them, and
+  `close` (or use as a context manager) to flush.
+  """
+  def __init__(self, path, buffer_records=DEFAULT_BUFFER_RECORDS, append=True):
+    self.path = path
+    self.names = []
+    if append and os.path.exists(names_path(path)):
+      with open(names_path(path)) as names_file:
+        self.names = json.load(names_file)
+    self.name_ids = {name: index for index, name in enumerate(self.names)}
+    self.file = open(path, 'ab' if append else 'wb')
+    self.buffer = bytearray()
+    self.buffer_bytes = buffer_records * _RECORD.size
+    self.battle = 0
+    self.records = {
+      events.Attack: self.attack_record,
+      events.Damage: self.damage_record,
+      events.Heal: self.heal_record,
+      events.AuraApplied: self.aura_applied_record,
+      events.AuraExpired: self.aura_expired_record,
+      events.Spawn: self.spawn_record,
+      events.Death: self.death_record,
+      events.Thorns: self.thorns_record,
+      events.TurnStart: self.turn_start_record,
+      events.AbilityUsed: self.ability_used_record,
+      events.ItemUsed: self.item_used_record,
+    }
+
+  def begin_battle(self, index):
+    self.battle = index
+
+  def intern(self, name):
+    name_id = self.name_ids.get(name)
+    if name_id is None:
+      name_id = self.name_ids[name] = len(self.names)
+      self.names.append(name)
+    return name_id
+
+  def actor_fields(self, actor):
+    """(registry ID, interned kind) of `actor`."""
+    if actor is None:
+      return -1, -1
+    actor_id = actor.actor_id
+    return (-1 if actor_id is None else actor_id,
+            self.intern(type(actor).__name__))
+
+  def emit(self, event):
+    record = self.records.get(type(event))
+    if record is None:
+      return
+    self.buffer += _RECORD.pack(*record(event))
+    if len(self.buffer) >= self.buffer_bytes:
+      self.flush()
+
+  def record(self, kind, actor=None, target=None, name=-1, value=0, hp=0,
+             crit=False):
+    return ((self.battle, kind, crit) + self.actor_fields(actor) +
+            self.actor_fields(target) + (name, value, hp))
+
+  def attack_record(self, event):
+    return self.record(ATTACK, event.attacker, event.target,
+                       value=event.damage, crit=event.crit)
+
+  def damage_record(self, event):
+    return self.record(DAMAGE, target=event.target, value=event.amount,
+                       hp=event.hp)
+
+  def heal_record(self, event):
+    return self.record(HEAL, target=event.target, value=event.amount,
+                       hp=event.hp)
+
+  def aura_applied_record(self, event):
+    return self.record(AURA_APPLIED, target=event.target,
+                       name=self.intern(event.aura.name))
+
+  def aura_expired_record(self, event):
+    return self.record(AURA_EXPIRED, target=event.actor,
+                       name=self.intern(event.aura.name))
+
+  def spawn_record(self, event):
+    return self.record(SPAWN, event.spawner, event.spawned)
+
+  def death_record(self, event):
+    return self.record(DEATH, target=event.actor)
+
+  def thorns_record(self, event):
+    return self.record(THORNS, event.source, event.target, value=event.damage)
+
+  def turn_start_record(self, event):
+    return self.record(TURN_START, event.actor)
+
+  def ability_used_record(self, event):
+    return self.record(ABILITY_USED, event.actor,
+                       name=self.intern(event.ability.name))
+
+  def item_used_record(self, event):
+    return self.record(ITEM_USED, event.actor, event.target,
+                       name=self.intern(repr(event.item)))
+
+  def flush(self):
+    self.file.write(self.buffer)
+    self.file.flush()
+    self.buffer = bytearray()
+    with open(names_path(self.path), 'w') as names_file:
+      json.dump(self.names, names_file)
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class ReplayLog():
+  """A binary log memory-mapped as a NumPy structured array.
+
+  Several logs can be combined with `concatenate`, which remaps their
+  interned names onto one table (and copies the records into memory).
+  """
+  def __init__(self, records, names):
+    self.records = records
+    self.names = names
+
+  @classmethod
+  def open(cls, path):
+    with open(names_path(path)) as names_file:
+      names = json.load(names_file)
+    if os.path.getsize(path):
+      records = np.memmap(path, dtype=RECORD_DTYPE, mode='r')
+    else:
+      records = np.zeros(0, dtype=RECORD_DTYPE)
+    return cls(records, names)
+
+  @classmethod
+  def concatenate(cls, logs):
+    name_ids = {}
+    parts = []
+    for log in logs:
+      mapping = np.array([name_ids.setdefault(name, len(name_ids))
+                          for name in log.names] + [-1], dtype='<i4')
+      records = np.array(log.records)
+      for field in ('actor_kind', 'target_kind', 'name'):
+        # Index -1 (unused) maps to the trailing -1.
+        records[field] = mapping[records[field]]
+      parts.append(records)
+    return cls(np.concatenate(parts) if parts
+               else np.zeros(0, dtype=RECORD_DTYPE), list(name_ids))
+
+  def __len__(self):
+    return len(self.records)
+
+  def name_id(self, name):
+    return self.names.index(name)
+
+  def of_kind(self, kind):
+    return self.records[self.records['kind'] == kind]
+
+  def total_by_name(self, kind, field, value='value'):
+    """{name: sum of `value`} over records of `kind`, grouped by `field`."""
+    records = self.of_kind(kind)
+    ids = records[field]
+    known = ids >= 0
+    totals = np.bincount(ids[known], weights=records[value][known],
+                         minlength=len(self.names))
+    return {self.names[index]: float(total)
+            for index, total in enumerate(totals) if total}
+
+  def damage_by_target_kind(self):
+    return self.total_by_name(DAMAGE, 'target_kind')
+
+  def damage_by_attacker_kind(self):
+    return self.total_by_name(ATTACK, 'actor_kind')
+
+  def count_by_kind(self):
+    counts = np.bincount(self.records['kind'], minlength=len(KIND_NAMES))
+    return {KIND_NAMES[kind]: int(count) for kind, count in enumerate(counts)
+            if count}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('paths', nargs='+', help='Binary logs to summarise.')
+  args = parser.parse_args()
+
+  logs = [ReplayLog.open(path) for path in args.paths]
+  log = logs[0] if len(logs) == 1 else ReplayLog.concatenate(logs)
+  print('%d records from %d battles' % (len(log),
+                                         len(np.unique(log.records['battle']))))
+  for title, totals in [('Records', log.count_by_kind()),
+                        ('Damage taken', log.damage_by_target_kind()),
+                        ('Attack damage dealt', log.damage_by_attacker_kind())]:
+    print(title)
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+      print('  %-24s %g' % (name, total))
+
+
+if __name__ == '__main__':
+  main()
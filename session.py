@@ -0,0 +1,210 @@
+"""Record interactive sessions and replay them as regression tests.
+
+Recording runs a scenario (a module with a `main(context)`, e.g.
+`boss_crawl`) with the usual console prompts, in a
+`battle_engine.BattleContext` seeded like battle 0 of a `simulate` run. Every
+choice is written to a JSON lines file as it happens: the options offered,
+the index chosen and a digest of the context's RNG states. Replaying seeds a
+context the same way and answers each prompt from the file, without blocking
+on input or printing. It checks at every step that the same options are
+offered in the same RNG state, and at the end that the session finished the
+same way.
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import random
+import time
+
+import battle_engine
+import events
+import simulate
+
+SESSION_VERSION = 1
+# How a session ended.
+COMPLETE = 'complete'
+INTERRUPTED = 'interrupted'
+
+
+class ReplayError(Exception):
+  """A replayed session diverged from its recording."""
+
+
+class _SessionExhausted(Exception):
+  """Raised to stop a session where its input ran out."""
+
+
+def rng_digest(context):
+  """Short digest of the stdlib and NumPy RNG states of `context`."""
+  digest = hashlib.blake2b(repr(context.rng.getstate()).encode(),
+                           digest_size=8)
+  digest.update(context.np_rng.get_state()[1].tobytes())
+  return digest.hexdigest()
+
+
+def run_scenario(scenario, context):
+  importlib.import_module(scenario).main(context)
+
+
+class RecordingPolicy(simulate.Policy):
+  """Asks `chooser` (the console by default) and logs each choice to `file`.
+
+  RNG digests are taken from `context`.
+  """
+  def __init__(self, file, context, chooser=battle_engine.prompt_choice):
+    self.file = file
+    self.context = context
+    self.chooser = chooser
+    self.steps = 0
+
+  def choose(self, options):
+    digest = rng_digest(self.context)
+    try:
+      index = self.chooser(options)
+    except (EOFError, KeyboardInterrupt):
+      # The player quit at a prompt: keep the session as interrupted there.
+      raise _SessionExhausted() from None
+    self.file.write(json.dumps({'options': [repr(option) for option in options],
+                                'choice': index, 'rng': digest}) + '\n')
+    # Keep the session so far if the game crashes or is interrupted.
+    self.file.flush()
+    self.steps += 1
+    return options[index]
+
+
+class ReplayPolicy(simulate.Policy):
+  """Answers with recorded choices, checking options and `context`'s RNGs."""
+  def __init__(self, steps, context, complete=True):
+    self.steps = steps
+    self.context = context
+    self.complete = complete
+    self.position = 0
+
+  def choose(self, options):
+    if self.position >= len(self.steps):
+      if self.complete:
+        raise ReplayError('The game asked for more than the %d recorded '
+                          'choices' % len(self.steps))
+      raise _SessionExhausted()
+    step = self.steps[self.position]
+    offered = [repr(option) for option in options]
+    if offered != step['options']:
+      raise ReplayError('Choice %d: offered %r, recorded %r' %
+                        (self.position, offered, step['options']))
+    if rng_digest(self.context) != step['rng']:
+      raise ReplayError('Choice %d: RNG state differs from the recording' %
+                        self.position)
+    self.position += 1
+    return options[step['choice']]
+
+
+def _outcome(error):
+  return 'error: %r' % error
+
+
+def record_session(scenario, path, seed=None):
+  """Play `scenario` on the console, recording the session to `path`.
+
+  A session whose input runs out, or is interrupted at a prompt, is recorded
+  as interrupted there.
+  """
+  if seed is None:
+    seed = random.SystemRandom().randrange(2**32)
+  with open(path, 'w') as session_file:
+    session_file.write(json.dumps({'version': SESSION_VERSION,
+                                   'scenario': scenario, 'seed': seed}) + '\n')
+    context = simulate.battle_context(seed, 0)
+    context.sink = events.ConsoleSink()
+    context.decisions = RecordingPolicy(session_file, context)
+    outcome = INTERRUPTED
+    try:
+      run_scenario(scenario, context)
+      outcome = COMPLETE
+    except _SessionExhausted:
+      outcome = INTERRUPTED
+    except Exception as error:
+      outcome = _outcome(error)
+      raise
+    finally:
+      session_file.write(json.dumps({'end': outcome}) + '\n')
+
+
+def load_session(path):
+  """Return (header, steps, outcome) of a recorded session."""
+  with open(path) as session_file:
+    lines = [json.loads(line) for line in session_file if line.strip()]
+  header, steps = lines[0], lines[1:]
+  if header.get('version') != SESSION_VERSION:
+    raise ValueError('%s: unsupported session version %r' %
+                     (path, header.get('version')))
+  outcome = INTERRUPTED
+  if steps and 'end' in steps[-1]:
+    outcome = steps.pop()['end']
+  return header, steps, outcome
+
+
+def replay_session(path):
+  """Replay the session at `path` silently; return its number of choices.
+
+  Raises ReplayError if the replay diverges from the recording.
+  """
+  header, steps, recorded_outcome = load_session(path)
+  context = simulate.battle_context(header['seed'], 0)
+  policy = ReplayPolicy(steps, context,
+                        complete=recorded_outcome != INTERRUPTED)
+  context.decisions = policy
+  try:
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+      run_scenario(header['scenario'], context)
+    outcome = COMPLETE
+  except _SessionExhausted:
+    outcome = INTERRUPTED
+  except ReplayError:
+    raise
+  except Exception as error:
+    outcome = _outcome(error)
+  if policy.position != len(steps):
+    raise ReplayError('The game ended after %d of %d recorded choices' %
+                      (policy.position, len(steps)))
+  if outcome != recorded_outcome:
+    raise ReplayError('Recorded %s, replayed %s' % (recorded_outcome, outcome))
+  return len(steps)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  record = subparsers.add_parser('record', help='Play and record a session.')
+  record.add_argument('scenario', help='Module to run, e.g. boss_crawl.')
+  record.add_argument('path')
+  record.add_argument('--seed', type=int, default=None)
+  replay = subparsers.add_parser('replay', help='Check recorded sessions.')
+  replay.add_argument('paths', nargs='+')
+  args = parser.parse_args()
+
+  if args.command == 'record':
+    record_session(args.scenario, args.path, args.seed)
+    return
+
+  failures = 0
+  choices = 0
+  start = time.perf_counter()
+  for path in args.paths:
+    try:
+      choices += replay_session(path)
+    except ReplayError as error:
+      failures += 1
+      print('%s: %s' % (path, error))
+  elapsed = time.perf_counter() - start
+  print('%d sessions (%d choices) replayed in %.2f s, %d failed' %
+        (len(args.paths), choices, elapsed, failures))
+  if failures:
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,526 @@
+"""Headless battle simulation driven by pluggable decision policies."""
+import argparse
+import collections
+import copy
+import glob
+import math
+import random
+
+import battle_engine
+import boss_crawl
+import create_character
+import events
+import grid
+import profiling
+
+import abilities
+
+
+DEFAULT_MAX_ROUNDS = 100
+# Battles per task submitted to the process pool.
+DEFAULT_SHARD_SIZE = 200
+
+BattleResult = collections.namedtuple('BattleResult',
+                                      ['won', 'rounds', 'hp_left'])
+
+
+class Policy():
+  """Answers `battle_engine.choose_option` calls in place of a human."""
+  actor = None
+  battle = None
+
+  def reset(self):
+    """Forget anything carried over from a previous battle."""
+
+  def start_turn(self, actor, battle):
+    self.actor = actor
+    self.battle = battle
+
+  def choose(self, options):
+    raise NotImplementedError
+
+  def __getstate__(self):
+    # The battle in progress is not part of the policy; leave it behind when
+    # shipping a policy to a worker process.
+    state = self.__dict__.copy()
+    state.pop('actor', None)
+    state.pop('battle', None)
+    return state
+
+
+class RandomPolicy(Policy):
+  """Picks uniformly at random, skipping options that never cost anything.
+
+  Draws from `rng`, or if it is None from the battle's context.
+  """
+  def __init__(self, rng=None):
+    self.rng = rng
+
+  def choose(self, options):
+    useful = [option for option in options
+              if option is not battle_engine.BACK
+              and option != battle_engine.LOOK]
+    rng = self.rng
+    if rng is None:
+      rng = self.battle.context.rng if self.battle else random
+    return rng.choice(useful or list(options))
+
+
+class GreedyDamagePolicy(Policy):
+  """Maximizes the damage dealt by the very next action."""
+  def __init__(self):
+    self.aura_target = None
+    # Scores of abilities this turn, by (action points left, ability). Every
+    # action spends action points, so scores last until the next action.
+    self.scores = {}
+    # (gain, index into [actor] + distinct enemies) by `aura_gain_key`.
+    self.aura_gains = {}
+
+  def reset(self):
+    self.aura_target = None
+    self.scores = {}
+
+  def start_turn(self, actor, battle):
+    Policy.start_turn(self, actor, battle)
+    self.scores = {}
+
+  def choose(self, options):
+    options = list(options)
+    if battle_engine.END_TURN in options:
+      return self.choose_action(options)
+    candidates = [option for option in options
+                  if option is not battle_engine.BACK]
+    if all(isinstance(option, battle_engine.Actor) for option in candidates):
+      return self.choose_target(candidates)
+    if all(isinstance(option, battle_engine.Ability) for option in candidates):
+      return self.choose_ability(candidates)
+    return candidates[0]
+
+  def choose_action(self, options):
+    attack_score = None
+    if battle_engine.ATTACK in options:
+      attack_score = max([min(attack_damage(self.actor, enemy), enemy.hp)
+                          for enemy in self.battle.enemies] or [0])
+    if battle_engine.ABILITY in options:
+      available = self.actor.get_available_abilities(self.actor.action_points,
+                                                     self.actor.mana)
+      ability_score = max([self.score_ability(ability)[0]
+                           for ability in available] or [0])
+      if attack_score is None or ability_score > attack_score:
+        return battle_engine.ABILITY
+    if attack_score is not None:
+      return battle_engine.ATTACK
+    return battle_engine.END_TURN
+
+  def choose_target(self, targets):
+    if self.aura_target is not None:
+      target, self.aura_target = self.aura_target, None
+      if target in targets:
+        return target
+    def score(target):
+      damage = attack_damage(self.actor, target)
+      return (damage >= target.hp, damage, -target.hp)
+    enemies = [target for target in targets if target in self.battle.enemies]
+    return max(enemies or targets, key=score)
+
+  def choose_ability(self, candidates):
+    best_score, best_ability, best_target = None, None, None
+    for ability in candidates:
+      score, target = self.score_ability(ability)
+      if best_score is None or score > best_score:
+        best_score, best_ability, best_target = score, ability, target
+    self.aura_target = best_target
+    return best_ability
+
+  def score_ability(self, ability):
+    """Return (damage gain, aura target or None) for using `ability`."""
+    key = (self.actor.action_points, ability)
+    score = self.scores.get(key)
+    if score is None:
+      score = self.scores[key] = self.compute_score(ability)
+    return score
+
+  def compute_score(self, ability):
+    if isinstance(ability, abilities.AreaFlames):
+      return sum(min(ability.amount, enemy.hp)
+                 for enemy in self.battle.enemies), None
+    if isinstance(ability, abilities.Pray):
+      # Pray is worth the best of the spells it will offer.
+      scores = [self.score_ability(spell)[0] for spell in ability.abilities]
+      return expected_best(scores, ability.num_choices), None
+    if isinstance(ability, abilities.AffectStat):
+      return self.best_aura_target(ability)
+    return 0, None
+
+  def best_aura_target(self, ability):
+    """Return (damage gain, target) for applying `ability`'s aura."""
+    # Enemies with the same stats and auras take the same damage, so score
+    # the first of each kind.
+    enemies = list({aura_state(enemy): enemy
+                    for enemy in reversed(self.battle.enemies)}.values())
+    enemies.reverse()
+    targets = [self.actor] + enemies
+    key = (ability, aura_state(self.actor), self.actor.get_offense()[3:],
+           tuple(self.actor.get_attack_tags())) + tuple(
+               aura_state(enemy) for enemy in enemies)
+    best = self.aura_gains.get(key)
+    if best is None:
+      best = self.aura_gain(ability, targets)
+      battle_engine.remember(self.aura_gains, key, best)
+    gain, index = best
+    return gain, None if index is None else targets[index]
+
+  def aura_gain(self, ability, targets):
+    """Return (damage gain, index of target) for the best of `targets`."""
+    enemies = targets[1:]
+    baseline = max([attack_damage(self.actor, enemy) for enemy in enemies] or
+                   [0])
+    best = (0, None)
+    for index, target in enumerate(targets):
+      with target.trial_aura(ability.aura_constructor()):
+        if target is self.actor:
+          gain = max([attack_damage(self.actor, enemy)
+                      for enemy in enemies] or [0]) - baseline
+        else:
+          # An aura on an enemy only changes the damage it takes, so it
+          # gains only by beating the best attack.
+          gain = attack_damage(self.actor, target) - baseline
+      if gain > best[0]:
+        best = (gain, index)
+    return best
+
+
+class ScriptedPolicy(Policy):
+  """Replays a fixed script of choices, then defers to `fallback`.
+
+  Each step is either an index into the offered options or an option value
+  (compared by equality or by its repr).
+  """
+  def __init__(self, script, fallback=None):
+    self.script = list(script)
+    self.position = 0
+    self.fallback = fallback
+
+  def reset(self):
+    self.position = 0
+    if self.fallback is not None:
+      self.fallback.reset()
+
+  def start_turn(self, actor, battle):
+    Policy.start_turn(self, actor, battle)
+    if self.fallback is not None:
+      self.fallback.start_turn(actor, battle)
+
+  def choose(self, options):
+    if self.position >= len(self.script):
+      if self.fallback is None:
+        raise IndexError('Script exhausted after %d choices' % self.position)
+      return self.fallback.choose(options)
+    step = self.script[self.position]
+    self.position += 1
+    if isinstance(step, int):
+      return options[step]
+    for option in options:
+      if option == step or repr(option) == step:
+        return option
+    raise ValueError('Scripted choice %r not among %r' % (step, options))
+
+
+def _mcts_policy():
+  # mcts builds on this module, so it is imported on first use.
+  import mcts
+  return mcts.MCTSPolicy()
+
+
+POLICIES = {
+  'random': RandomPolicy,
+  'greedy': GreedyDamagePolicy,
+  'mcts': _mcts_policy,
+}
+
+
+def aura_state(actor):
+  """Everything but the equipped weapon that an actor's stat getters read."""
+  return (actor.stats.values.tobytes(), actor.aura_sums.tobytes(),
+          actor.aura_products.tobytes())
+
+
+def expected_best(scores, num_drawn):
+  """Expected maximum of `num_drawn` of `scores` drawn without replacement."""
+  scores = sorted(scores)
+  num_drawn = min(num_drawn, len(scores))
+  if not num_drawn:
+    return 0
+  # The score of rank r is the maximum when the other draws are all among
+  # the r below it.
+  total = sum(score * math.comb(rank, num_drawn - 1)
+              for rank, score in enumerate(scores))
+  return total / math.comb(len(scores), num_drawn)
+
+
+def attack_damage(attacker, target):
+  """Expected non-crit damage of a standard attack by `attacker`."""
+  if isinstance(attacker, battle_engine.Player):
+    tags = attacker.get_attack_tags()
+  else:
+    tags = attacker.get_standard_attack_tags()
+  return sum(attacker.get_attack_damages(target, tags))
+
+
+def run_battle(battle, max_rounds=DEFAULT_MAX_ROUNDS):
+  """Play `battle` to completion without prompting; return (won, rounds)."""
+  rounds = 0
+  while battle.players and battle.enemies and rounds < max_rounds:
+    battle.run_round()
+    rounds += 1
+  return bool(battle.players) and not battle.enemies, rounds
+
+
+def simulate_battle(cells, encounter, policy, inventory=(),
+                    max_rounds=DEFAULT_MAX_ROUNDS, sink=None, context=None):
+  """Build a battle like `boss_crawl.create_battle` and play it headless.
+
+  Events go to `sink`, or nowhere if it is None. If a
+  `battle_engine.BattleContext` is given, the battle runs in it with
+  `policy` and `sink`, and the global policy, sink and RNGs are left alone.
+  """
+  player = create_character.create_character(
+      'Anzacel', cells, copy.deepcopy(list(inventory)))
+  policy.reset()
+  if context is not None:
+    context.decisions = policy
+    context.sink = sink or events.NullSink()
+    battle = boss_crawl.create_battle(player, encounter, context)
+    won, rounds = run_battle(battle, max_rounds)
+    return BattleResult(won, rounds, player.hp)
+  battle = boss_crawl.create_battle(player, encounter)
+  previous_policy = battle_engine.set_decision_policy(policy)
+  previous_sink = events.set_sink(sink or events.NullSink())
+  try:
+    won, rounds = run_battle(battle, max_rounds)
+  finally:
+    battle_engine.set_decision_policy(previous_policy)
+    events.set_sink(previous_sink)
+  return BattleResult(won, rounds, player.hp)
+
+
+class Tally():
+  """Running totals over battle results."""
+  def __init__(self):
+    self.battles = 0
+    self.wins = 0
+    self.rounds = 0
+    self.hp_left = 0
+
+  def add(self, result):
+    self.battles += 1
+    self.wins += result.won
+    self.rounds += result.rounds
+    self.hp_left += result.hp_left
+
+  def merge(self, other):
+    self.battles += other.battles
+    self.wins += other.wins
+    self.rounds += other.rounds
+    self.hp_left += other.hp_left
+
+  def win_rate(self):
+    return self.wins / self.battles if self.battles else 0
+
+  def mean_rounds(self):
+    return self.rounds / self.battles if self.battles else 0
+
+  def mean_hp_left(self):
+    return self.hp_left / self.battles if self.battles else 0
+
+  def __repr__(self):
+    return ('%d battles: win rate %.3f, mean rounds %.2f, mean hp left %.2f' %
+            (self.battles, self.win_rate(), self.mean_rounds(),
+             self.mean_hp_left()))
+
+
+def _seed_state(master_seed, index):
+  import numpy as np
+  return np.random.SeedSequence(master_seed,
+                                spawn_key=(index,)).generate_state(4)
+
+
+def seed_battle(master_seed, index):
+  """Seed the stdlib and NumPy global RNGs for battle `index` of a run.
+
+  Every battle gets its own stream derived from (master_seed, index), so a
+  run's results do not depend on how battles are split between workers.
+  """
+  import numpy as np
+  state = _seed_state(master_seed, index)
+  random.seed(int.from_bytes(state.tobytes(), 'little'))
+  np.random.seed(state)
+
+
+def battle_context(master_seed, index):
+  """A `battle_engine.BattleContext` for battle `index` of a run.
+
+  Its RNGs are seeded as `seed_battle` seeds the global ones.
+  """
+  import numpy as np
+  state = _seed_state(master_seed, index)
+  return battle_engine.BattleContext(
+      rng=random.Random(int.from_bytes(state.tobytes(), 'little')),
+      np_rng=np.random.RandomState(state))
+
+
+def run_battles(cells, encounter, policy, num_battles, inventory=(),
+                max_rounds=DEFAULT_MAX_ROUNDS, seed=None, start=0, sink=None,
+                isolated=False):
+  """Play battles `start` to `start + num_battles` of a run and tally them.
+
+  If `seed` is given, each battle is seeded with `seed_battle`. Events go to
+  `sink`, which is told the index of each battle, or nowhere if it is None.
+  With `isolated`, each battle runs in its own `battle_context` instead, and
+  no global state is touched.
+  """
+  tally = Tally()
+  for index in range(start, start + num_battles):
+    context = None
+    if isolated:
+      context = battle_context(seed, index)
+    elif seed is not None:
+      seed_battle(seed, index)
+    if sink is not None:
+      sink.begin_battle(index)
+    tally.add(simulate_battle(cells, encounter, policy, inventory,
+                              max_rounds, sink, context))
+  return tally
+
+
+def _run_shard(args):
+  *battle_args, profile, log_prefix = args
+  sink = None
+  if log_prefix is not None:
+    import replay_log
+    start = battle_args[-1]
+    sink = replay_log.BinaryLogSink('%s-%08d.bin' % (log_prefix, start),
+                                    append=False)
+  profiler = profiling.Profiler() if profile else None
+  previous_profiler = profiling.set_profiler(profiler)
+  try:
+    return run_battles(*battle_args, sink=sink), profiler
+  finally:
+    profiling.set_profiler(previous_profiler)
+    if sink is not None:
+      sink.close()
+
+
+def run_battles_parallel(cells, encounter, policy, num_battles, seed,
+                         inventory=(), max_rounds=DEFAULT_MAX_ROUNDS,
+                         workers=None, shard_size=DEFAULT_SHARD_SIZE,
+                         profiler=None, log_prefix=None):
+  """Like `run_battles`, sharded over a process pool.
+
+  The result for a given `seed` is the same for any number of workers. If a
+  `profiling.Profiler` is given, every shard is profiled and the timings are
+  merged into it. With `log_prefix`, each shard writes a `replay_log` binary
+  log named after the prefix and its first battle, replacing any old one.
+  """
+  import concurrent.futures
+  shards = [(cells, encounter, policy, min(shard_size, num_battles - start),
+             inventory, max_rounds, seed, start, profiler is not None,
+             log_prefix)
+            for start in range(0, num_battles, shard_size)]
+  tally = Tally()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    # map() yields in submission order, so totals are summed deterministically.
+    for shard_tally, shard_profiler in pool.map(_run_shard, shards):
+      tally.merge(shard_tally)
+      if profiler is not None:
+        profiler.merge(shard_profiler)
+  return tally
+
+
+def run_battles_threaded(cells, encounter, policy, num_battles, seed,
+                         inventory=(), max_rounds=DEFAULT_MAX_ROUNDS,
+                         workers=None, shard_size=DEFAULT_SHARD_SIZE):
+  """Like `run_battles_parallel`, over a thread pool in this process.
+
+  Shards run isolated battles with their own copy of `policy`, so the result
+  for a given `seed` is the same as from `run_battles`. Nothing is pickled,
+  but shards only run simultaneously on free-threaded Python builds.
+  """
+  import concurrent.futures
+  def run_shard(start):
+    return run_battles(cells, encounter, copy.deepcopy(policy),
+                       min(shard_size, num_battles - start), inventory,
+                       max_rounds, seed, start, isolated=True)
+  tally = Tally()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    for shard_tally in pool.map(run_shard, range(0, num_battles, shard_size)):
+      tally.merge(shard_tally)
+  return tally
+
+
+def find_cells(names):
+  """Look up grid cells by name, in breadth-first order of the grid."""
+  cells = []
+  for name in names:
+    matches = [cell for cell in grid.compiled_grid.cells
+               if cell.name == name and cell not in cells]
+    if not matches:
+      raise ValueError('No grid cell named %r' % name)
+    cells.append(matches[0])
+  return cells
+
+
+def parse_encounter(text):
+  """Parse 'papa roach=1,horn dog=2' into an encounter Counter."""
+  encounter = collections.Counter()
+  for part in filter(None, text.split(',')):
+    boss, _, number = part.partition('=')
+    encounter[boss.strip()] += int(number or 1)
+  return encounter
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--battles', type=int, default=1000)
+  parser.add_argument('--policy', choices=sorted(POLICIES), default='greedy')
+  parser.add_argument('--build', default='',
+                      help='Comma-separated grid cell names.')
+  parser.add_argument('--encounter', default='papa roach=1',
+                      help="Comma-separated 'boss=count' pairs.")
+  parser.add_argument('--max-rounds', type=int, default=DEFAULT_MAX_ROUNDS)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=None,
+                      help='Worker processes; defaults to the CPU count.')
+  parser.add_argument('--threads', action='store_true',
+                      help='Use worker threads instead of processes.')
+  parser.add_argument('--profile', action='store_true',
+                      help='Print time spent per engine phase.')
+  parser.add_argument('--log', metavar='PREFIX',
+                      help='Write binary event logs to PREFIX-*.bin.')
+  args = parser.parse_args()
+  if args.threads and (args.profile or args.log):
+    parser.error('--profile and --log need worker processes')
+  if args.log and glob.glob(glob.escape(args.log) + '-*.bin'):
+    # Old shards would be mixed into the new run's logs.
+    parser.error('logs %s-*.bin already exist' % args.log)
+
+  cells = find_cells([name for name in args.build.split(',') if name])
+  if args.threads:
+    print(run_battles_threaded(cells, parse_encounter(args.encounter),
+                               POLICIES[args.policy](), args.battles,
+                               args.seed, max_rounds=args.max_rounds,
+                               workers=args.workers))
+    return
+  profiler = profiling.Profiler() if args.profile else None
+  tally = run_battles_parallel(cells, parse_encounter(args.encounter),
+                               POLICIES[args.policy](), args.battles,
+                               args.seed, max_rounds=args.max_rounds,
+                               workers=args.workers, profiler=profiler,
+                               log_prefix=args.log)
+  print(tally)
+  if profiler is not None:
+    print(profiler.report())
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+"""Headless batches of endless boss crawls.
+
+Plays many full crawls like `boss_crawl.main`, one character fighting
+escalating encounters until it dies, across a process pool. Per-run results
+are appended to a CSV file as they come in. Only a count of runs per score
+is kept in memory, so memory use does not grow with the number of runs.
+"""
+import argparse
+import collections
+import concurrent.futures
+import copy
+import csv
+import os
+
+import battle_engine
+import boss_crawl
+import create_character
+import events
+import simulate
+
+DEFAULT_MAX_BATTLES = 1000
+# Runs per task submitted to the process pool.
+DEFAULT_CHUNK_SIZE = 20
+# Tasks kept in flight per worker, so results are written as runs finish
+# without queueing every run up front.
+TASKS_PER_WORKER = 4
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+
+# `death_battle` is the 1-based battle the run ended in, `death_enemies` the
+# enemies it started with, and `rounds` the rounds played over the whole run.
+# A run that wins `max_battles` battles ends undefeated with
+# `death_battle` 0.
+CrawlResult = collections.namedtuple(
+    'CrawlResult', ['run', 'score', 'death_battle', 'death_enemies',
+                    'rounds'])
+
+
+def run_crawl(run, cells, policy, difficulty=None, seed=None, inventory=(),
+              max_battles=DEFAULT_MAX_BATTLES,
+              max_rounds=simulate.DEFAULT_MAX_ROUNDS):
+  """Play crawl number `run` to the end; return a `CrawlResult`.
+
+  A battle that lasts `max_rounds` rounds counts as lost. If `seed` is given,
+  the run is seeded with `simulate.seed_battle`, so results do not depend on
+  how runs are split between workers.
+  """
+  if seed is not None:
+    simulate.seed_battle(seed, run)
+  anzacel = create_character.create_character(
+      'Anzacel', cells, copy.deepcopy(list(inventory)))
+  policy.reset()
+  previous_policy = battle_engine.set_decision_policy(policy)
+  previous_sink = events.set_sink(events.NullSink())
+  try:
+    encounter = collections.Counter()
+    battle = boss_crawl.create_battle(anzacel, encounter)
+    score = 0
+    total_rounds = 0
+    while score < max_battles:
+      enemy_names = ', '.join(enemy.name for enemy in battle.enemies)
+      won, rounds = simulate.run_battle(battle, max_rounds)
+      total_rounds += rounds
+      if not won:
+        return CrawlResult(run, score, score + 1, enemy_names, total_rounds)
+      score += 1
+      battle = boss_crawl.next_battle(anzacel, encounter, score, difficulty)
+  finally:
+    battle_engine.set_decision_policy(previous_policy)
+    events.set_sink(previous_sink)
+  return CrawlResult(run, score, 0, '', total_rounds)
+
+
+def _run_chunk(args):
+  start, num_runs, crawl_args = args
+  return [run_crawl(run, *crawl_args) for run in range(start, start + num_runs)]
+
+
+def run_crawls_parallel(cells, policy, num_runs, path, difficulty=None,
+                        seed=None, inventory=(),
+                        max_battles=DEFAULT_MAX_BATTLES,
+                        max_rounds=simulate.DEFAULT_MAX_ROUNDS, workers=None,
+                        chunk_size=DEFAULT_CHUNK_SIZE):
+  """Play `num_runs` crawls over a process pool, writing results to `path`.
+
+  Rows are written in the order runs finish. Returns a Counter of runs per
+  score.
+  """
+  crawl_args = (cells, policy, difficulty, seed, inventory, max_battles,
+                max_rounds)
+  chunks = ((start, min(chunk_size, num_runs - start), crawl_args)
+            for start in range(0, num_runs, chunk_size))
+  scores = collections.Counter()
+  with open(path, 'w', newline='') as results_file, \
+       concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    writer = csv.writer(results_file)
+    writer.writerow(CrawlResult._fields)
+    max_pending = TASKS_PER_WORKER * (workers or os.cpu_count() or 1)
+    pending = set()
+    while True:
+      for chunk in chunks:
+        pending.add(pool.submit(_run_chunk, chunk))
+        if len(pending) >= max_pending:
+          break
+      if not pending:
+        break
+      done, pending = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        for result in future.result():
+          writer.writerow(result)
+          scores[result.score] += 1
+      results_file.flush()
+  return scores
+
+
+def percentile(counts, percent):
+  """The `percent`th percentile (nearest rank) of values tallied in `counts`."""
+  total = sum(counts.values())
+  rank = max(1, -(-percent * total // 100))
+  seen = 0
+  for value in sorted(counts):
+    seen += counts[value]
+    if seen >= rank:
+      return value
+  return None
+
+
+def histogram(counts, width=50):
+  """Text histogram of a Counter, one line per value."""
+  if not counts:
+    return ''
+  most = max(counts.values())
+  return '\n'.join('%5d %7d %s' % (value, counts[value],
+                                   '#' * max(1, counts[value] * width // most))
+                   for value in range(min(counts), max(counts) + 1)
+                   if counts[value])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--runs', type=int, default=1000)
+  parser.add_argument('--policy', choices=sorted(simulate.POLICIES),
+                      default='greedy')
+  parser.add_argument('--build', default='',
+                      help='Comma-separated grid cell names.')
+  parser.add_argument('--difficulty', choices=['easy', 'hard'],
+                      default=boss_crawl.DIFFICULTY)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--max-battles', type=int, default=DEFAULT_MAX_BATTLES)
+  parser.add_argument('--max-rounds', type=int,
+                      default=simulate.DEFAULT_MAX_ROUNDS)
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+  parser.add_argument('--output', default='crawl_results.csv')
+  args = parser.parse_args()
+
+  cells = simulate.find_cells([name for name in args.build.split(',') if name])
+  scores = run_crawls_parallel(cells, simulate.POLICIES[args.policy](),
+                               args.runs, args.output, args.difficulty,
+                               args.seed, max_battles=args.max_battles,
+                               max_rounds=args.max_rounds,
+                               workers=args.workers,
+                               chunk_size=args.chunk_size)
+  if scores:
+    print(histogram(scores))
+    print('  '.join('p%d %d' % (percent, percentile(scores, percent))
+                    for percent in PERCENTILES))
+  print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,18 @@
+"""The batch engine must play like `Battle.run_round`."""
+import pytest
+
+import batch_battle
+import enemies
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_object_engine(seed):
+  expected, actual = batch_battle.check_equivalence(num_battles=300,
+                                                    seed=seed)
+  assert expected.battles == actual.battles == 300
+
+
+def test_rejects_unsupported_enemies():
+  battle = batch_battle.default_battle()
+  with pytest.raises(ValueError):
+    batch_battle.check_supported(battle.players[0], [enemies.PapaRoach()])
@@ -0,0 +1,17 @@
+"""MCTS must never play worse than the policy it falls back on."""
+import mcts
+import simulate
+
+BUILD = ['Max HP +2', 'Physical Power +1', 'Physical Strength *2']
+
+
+def test_plays_prior_when_options_are_not_separated():
+  cells = simulate.find_cells(BUILD)
+  encounter = simulate.parse_encounter('papa roach=1')
+  greedy = simulate.run_battles(cells, encounter,
+                                simulate.GreedyDamagePolicy(), 20, seed=0)
+  # A single iteration per decision tries only the prior's choice.
+  search = simulate.run_battles(cells, encounter, mcts.MCTSPolicy(1), 20,
+                                seed=0)
+  assert (search.wins, search.rounds, search.hp_left) == (
+      greedy.wins, greedy.rounds, greedy.hp_left)
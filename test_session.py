@@ -0,0 +1,15 @@
+"""Recorded sessions must replay."""
+import io
+
+import session
+
+
+def test_replays_session_cut_short(tmp_path, monkeypatch):
+  path = str(tmp_path / 'session.jsonl')
+  # Pick three grid cells, then run out of input.
+  monkeypatch.setattr('sys.stdin', io.StringIO('0\n0\n0\n'))
+  session.record_session('boss_crawl', path, seed=5)
+  header, steps, outcome = session.load_session(path)
+  assert outcome == session.INTERRUPTED
+  assert len(steps) == 3
+  assert session.replay_session(path) == 3
@@ -1,7 +1,10 @@
 import battle_engine
+import events
 
 
 class Weapon(battle_engine.Item):
+  __slots__ = ('name',)
+
   def __init__(self, name):
     self.name = name
 
@@ -12,7 +15,9 @@ class Weapon(battle_engine.Item):
     return [user]
 
   def use(self, user, target):
-    print('%s equipped %s' % (user.name, self.name))
+    sink = user.context.sink
+    if sink.enabled:
+      sink.emit(events.Message('%s equipped %s' % (user.name, self.name)))
     user.equipped = self
 
   def __repr__(self):
@@ -21,6 +26,8 @@ class Weapon(battle_engine.Item):
 
 class Sword(Weapon):
   """A basic deterministic physical weapon."""
+  __slots__ = ('base_power', 'tags')
+
   def __init__(self, name, base_power):
     Weapon.__init__(self, name)
     self.base_power = base_power
@@ -35,6 +42,8 @@ class Sword(Weapon):
 
 class MagicWand(Weapon):
   """A basic deterministic special weapon."""
+  __slots__ = ('base_power', 'tags')
+
   def __init__(self, name, base_power):
     Weapon.__init__(self, name)
     self.base_power = base_power